@@ -8,7 +8,11 @@ import uuid
 from pprint import pprint
 
 from extracthendrix.generic import ComputedValues, FolderLayout, validity_date, get_model_names, get_variable_instances
-from extracthendrix.readers import AromeHendrixReader
+from extracthendrix.readers import AromeHendrixReader, NativeFilePrefetcher, FTPSessionPool, \
+    DirectoryListingCache, VortexLocateCache, get_members, ingest_native_files, \
+    locate_native_files_by_step, prestaging_request_content, PrestagingPipeline
+from extracthendrix.native_store import SharedNativeStore
+from extracthendrix.journal import WorkJournal
 from extracthendrix.hendrix_emails import send_problem_extraction_email, send_script_stopped_email, send_success_email
 from extracthendrix.config.variables import arome, pearome, arome_analysis, arome_analysis_p0, arome_analysis_p1, arpege, arpege_analysis_4dvar, pearp
 from extracthendrix.config.domains import domains_descriptions
@@ -40,13 +44,15 @@ def delete_last_file_in_folder(path):
         latest_file = max(list_of_files, key=os.path.getctime)
         os.remove(latest_file)
         logger.info(f"Deleted {latest_file}")
+        return latest_file
 
 
 def retry_and_finally_raise(
         onRetry=onRetryDefault,
         onFailure=onFailureDefault,
         layout=None,
-        time_retries=[timedelta(hours=0.01)]):  # timedelta(hours=n) for n in [0.5, 1, 2, 3, 6]
+        time_retries=[timedelta(hours=0.01)],  # timedelta(hours=n) for n in [0.5, 1, 2, 3, 6]
+        journal=None):
     """
     Decorator to retry extraction when an error is raised, until a point where we assume the code failed and raise
     an exception.
@@ -58,6 +64,7 @@ def retry_and_finally_raise(
     :param onFailure: Function to print on failure.
     :param time_retries: Time intervals to wait before trying to relaunch extraction.
     :type time_retries: list of datetime.timedelta.
+    :param journal: WorkJournal where the deleted file is forgotten (optional).
     """
     def decorator_retry(func):
         @functools.wraps(func)
@@ -77,7 +84,9 @@ def retry_and_finally_raise(
                 onFailure(E, timeutils.asctime())
                 if layout:
                     # delete_last_file_in_folder(layout._cache_)
-                    delete_last_file_in_folder(layout._computed_)
+                    deleted_file = delete_last_file_in_folder(layout._computed_)
+                    if journal is not None and deleted_file is not None:
+                        journal.forget('computed', deleted_file)
                     # delete_last_file_in_folder(layout._native_)
                 raise E
         return wrapper_retry
@@ -228,6 +237,12 @@ def check_config_user(config_user):
         assert (config_user["end_term"] -
                 config_user["start_term"] + 1) == 24, str_raise
 
+    assert config_user.get("compute_mode", "term") in ["term", "batch"], "compute_mode must be 'term' or 'batch'"
+    if config_user.get("lazy", False):
+        assert config_user.get("compute_mode", "term") == "batch", "lazy mode requires compute_mode='batch'"
+    if config_user.get("member_processes", 0) > 1:
+        assert config_user.get("compute_mode", "term") == "term", "member_processes requires compute_mode='term'"
+
     return config_user
 
 # send_problem_extraction_email(config_user)
@@ -244,7 +259,24 @@ def _execute(
         variables=[],
         model=None,
         members=[None],
-        dtype='32bits'
+        dtype='32bits',
+        prefetch_depth=0,
+        prefetch_workers=2,
+        single_pass_domains=False,
+        max_opened_files=64,
+        max_opened_bytes=None,
+        compute_mode='term',
+        stream_final=False,
+        member_workers=4,
+        shared_store_path=None,
+        shared_store_max_bytes=None,
+        wait_native=None,
+        tape_order=False,
+        member_processes=0,
+        domain_workers=1,
+        lazy=False,
+        lazy_chunks=None,
+        resume_journal=False
 ):
     logger.info("[CONFIG READER] Start extraction")
 
@@ -257,6 +289,22 @@ def _execute(
     # Initialize grouper
     grouper = Grouper(groupby)
 
+    # Native files shared with other extractions
+    shared_store = SharedNativeStore(shared_store_path, shared_store_max_bytes) if shared_store_path else None
+
+    # Files done by previous launches of the extraction
+    journal = None
+    if resume_journal:
+        journal = WorkJournal(
+            os.path.join(layout.work_folder, "journal.jsonl"),
+            folders={'native': layout._native_, 'cache': layout._cache_,
+                     'computed': layout._computed_, 'final': layout._final_})
+
+    if compute_mode == 'batch' and member_processes:
+        # Batches are computed in the main process (see ComputedValues.compute_batch)
+        logger.warning("[CONFIG READER] member_processes is ignored with compute_mode='batch'")
+        member_processes = 0
+
     # Initialize computer
     computer = ComputedValues(
         layout,
@@ -265,12 +313,49 @@ def _execute(
         autofetch_native=True,
         model=model,
         members=members,
-        dtype=dtype
+        dtype=dtype,
+        single_pass_domains=single_pass_domains,
+        max_opened_files=max_opened_files,
+        max_opened_bytes=max_opened_bytes,
+        stream_final=stream_final,
+        member_workers=member_workers,
+        shared_store=shared_store,
+        member_processes=member_processes,
+        domain_workers=domain_workers,
+        lazy=lazy,
+        lazy_chunks=lazy_chunks,
+        journal=journal
     )
 
+    # Download native files of the next time steps while computing the current one
+    timeiterator = list(timeiterator)
+    prefetcher = None
+    if prefetch_depth:
+        prefetcher = NativeFilePrefetcher(
+            computer.get_readers(),
+            depth=prefetch_depth,
+            workers=prefetch_workers,
+            tape_order=tape_order,
+            locate_cache=VortexLocateCache(os.path.join(layout.work_folder, "vortex_locations.json"))
+        )
+
     previous_date = None
+    batch = []
+
+    def finish_batch(time_tag, batch):
+        """Write final files of a batch (e.g. a day or a month)"""
+        if compute_mode == 'batch':
+            retry_and_finally_raise(
+                onRetry=onRetry,
+                onFailure=onFailure,
+                layout=layout,
+                journal=journal
+            )(computer.compute_batch)(batch, time_tag, prefetcher)
+        else:
+            computer.concat_and_clean_computed_folder(time_tag)
+        computer.clean_cache_folder()
 
-    for date_, term in timeiterator:
+    for index, (date_, term) in enumerate(timeiterator):
         logger.info(f"[CONFIG READER] Start {date_}, term {term}")
         current_date = (date_, term)
 
@@ -280,31 +365,53 @@ def _execute(
                 f"[CONFIG READER] File {date_}, term {term}, already in final")
             continue
         else:
+            if wait_native is not None:
+                # e.g. wait for native files to be prestaged and downloaded
+                wait_native(*current_date)
+
             if previous_date is not None:
                 if grouper.batch_is_complete(previous_date, current_date):
                     logger.info(
                         f"[CONFIG READER] File {date_}, term {term}, grouped in batch")
-                    computer.concat_and_clean_computed_folder(
-                        grouper.filetag(*previous_date))
-                    computer.clean_cache_folder()
+                    finish_batch(grouper.filetag(*previous_date), batch)
+                    batch = []
+
+            if compute_mode == 'batch':
+                # Time steps are computed all at once when the batch is complete
+                batch.append(current_date)
+                previous_date = (date_, term)
+                continue
+
+            if prefetcher:
+                next_dates = [next_date for next_date in timeiterator[index+1:index+1+prefetch_depth]
+                              if not computer.files_are_in_final(grouper.filetag(*next_date))]
+                prefetcher.schedule(next_dates)
+                prefetcher.wait(*current_date)
 
             retry_and_finally_raise(
                 onRetry=onRetry,
                 onFailure=onFailure,
-                layout=layout
-            )(computer.compute)(*current_date)
+                layout=layout,
+                journal=journal
+            )(computer.compute)(*current_date, grouper.filetag(*current_date))
 
             previous_date = (date_, term)
 
-    last_time_tag = grouper.filetag(*previous_date)
-    logger.info(f"[CONFIG READER] File {date_}, term {term}, grouped in batch")
-    computer.concat_and_clean_computed_folder(last_time_tag)
-    computer.clean_cache_folder()
+    if previous_date is not None:
+        last_time_tag = grouper.filetag(*previous_date)
+        logger.info(f"[CONFIG READER] File {date_}, term {term}, grouped in batch")
+        finish_batch(last_time_tag, batch)
+
+    if prefetcher:
+        prefetcher.shutdown()
+        prefetcher.locate_cache.save()
+    computer.close()
 
     # Clean predictions
     layout.clean_layout()
-    computer.make_surfex_compliant()
     computer.clean_final_folder()
+    if journal is not None:
+        journal.delete()
 
     # Record end time
     extraction_ends = datetime.now()
@@ -335,67 +442,286 @@ def execute(config_user):
             start_term=6,
             end_term=29)
 
+    Optional keys:
+
+        - prefetch_depth: number of time steps whose native files are downloaded in advance (default 0, disabled)
+        - prefetch_workers: number of simultaneous downloads when prefetching (default 2)
+        - tape_order: when prefetching, download files of the next prefetch_depth time steps in the order of their
+          path on Hendrix to limit tape mounts, time steps being still computed in time order (default False)
+        - single_pass_domains: read each native field once and write the cache files of all domains (default False)
+        - max_opened_files: maximum number of files in cache kept opened by each cache manager (default 64)
+        - max_opened_bytes: maximum size in bytes of files in cache kept opened by each cache manager (default None)
+        - compute_mode: 'term' to compute and save each time step separately (default), or 'batch' to compute
+          all time steps of a group (see groupby) at once on (time, yy, xx) arrays and save the final file directly
+        - stream_final: append each time step to the final file instead of saving it in _computed_ (default False)
+        - members: list of members of an ensemble model, each one extracted in its own final file, or 'all' for
+          all members listed in config/models.ini (default [None]: a single extraction, members of models.ini being
+          tried in turn until a file is found)
+        - member_workers: number of simultaneous downloads of the native files of the members (default 4)
+        - member_processes: number of processes computing members simultaneously, each process handling the same
+          members during the whole extraction, with compute_mode='term' only (default 0, members are computed
+          in the main process)
+        - domain_workers: number of threads computing and writing the domains simultaneously (default 1)
+        - lazy: with compute_mode='batch', read files in cache as dask arrays and write all final files of a group
+          with a single dask computation (default False)
+        - lazy_chunks: chunks of files in cache when lazy is True, e.g. {'xx': 256, 'yy': 256} (default None,
+          one chunk per file)
+        - resume_journal: record files done in work_folder/journal.jsonl, and read it instead of checking files
+          one by one when the extraction is relaunched, useful for long extractions on NFS (default False)
+        - shared_store_path: folder where native files are shared with other extractions (default None, disabled)
+        - shared_store_max_bytes: maximum size in bytes of the shared folder, least recently used files are
+          deleted first (default None, no limit)
+        - bulk_ingest: download all native files by FTP before the extraction, once they are prestaged
+          (default False, see ingest_prestaged_files)
+        - auto_prestaging: submit prestaging requests on Hendrix and extract each time step as soon as its files
+          are prestaged and downloaded (default False, see start_prestaging_pipeline)
+        - ftp_workers: number of simultaneous FTP transfers when bulk_ingest or auto_prestaging is True (default 4)
+
     :param config_user: Dictionary containing the configuration as given by the user.
     """
     config_user = check_config_user(config_user)
     # A trick to use c.attribute instead of c["attribute"]
     c = DictNamespace(config_user)
 
+    # Download all prestaged files at once instead of one vortex request for each file
+    if c.get('bulk_ingest', False):
+        ingest_prestaged_files(config_user)
+
+    # Submit prestaging requests and download native files as soon as they are prestaged
+    pipeline = start_prestaging_pipeline(config_user) if c.get('auto_prestaging', False) else None
+
     iterator = TimeIterator(config_user).get_iterator()
 
-    _execute(
-        iterator,
-        onRetry=send_problem_extraction_email(config_user),
-        onFailure=send_script_stopped_email(config_user),
-        onSuccess=send_success_email(config_user),
-        work_folder=c.work_folder,
-        groupby=c.groupby,
-        domain=c.domain,
-        variables=c.variables,
-        model=c.model,
-        members=c.get('members', [None]),
-        dtype=c.get('dtype', '32bits')
-    )
+    try:
+        _execute(
+            iterator,
+            onRetry=send_problem_extraction_email(config_user),
+            onFailure=send_script_stopped_email(config_user),
+            onSuccess=send_success_email(config_user),
+            work_folder=c.work_folder,
+            groupby=c.groupby,
+            domain=c.domain,
+            variables=c.variables,
+            model=c.model,
+            members=c.get('members', [None]),
+            dtype=c.get('dtype', '32bits'),
+            prefetch_depth=c.get('prefetch_depth', 0),
+            prefetch_workers=c.get('prefetch_workers', 2),
+            single_pass_domains=c.get('single_pass_domains', False),
+            max_opened_files=c.get('max_opened_files', 64),
+            max_opened_bytes=c.get('max_opened_bytes', None),
+            compute_mode=c.get('compute_mode', 'term'),
+            stream_final=c.get('stream_final', False),
+            member_workers=c.get('member_workers', 4),
+            shared_store_path=c.get('shared_store_path', None),
+            shared_store_max_bytes=c.get('shared_store_max_bytes', None),
+            wait_native=pipeline.wait if pipeline else None,
+            tape_order=c.get('tape_order', False),
+            member_processes=c.get('member_processes', 0),
+            domain_workers=c.get('domain_workers', 1),
+            lazy=c.get('lazy', False),
+            lazy_chunks=c.get('lazy_chunks', None),
+            resume_journal=c.get('resume_journal', False)
+        )
+    finally:
+        if pipeline:
+            pipeline.close()
 
 
 def _get_prestaging_file_list(
         iterator,
         model,
         variables,
-        members):
+        members,
+        listing_cache_path=None,
+        listing_cache_ttl=None,
+        locate_cache_path=None,
+        locate_workers=4):
     """
     Prepare a list with the content of a prestaging file.
 
-    :param config_user: Dictionary containing the configuration as given by the user.
+    A single FTP session is used, and each folder on Hendrix is listed only once.
+    Resources are located with vortex in a pool of threads, and their locations can be saved on disk.
+
+    :param iterator: Iterator on (date, term)
+    :param model: Model name
+    :param variables: Computed variables names
+    :param members: List of members, or 'all' for all members listed in config/models.ini.
+    :param listing_cache_path: Path to a json file where listings of Hendrix folders are saved (optional)
+    :param listing_cache_ttl: Time to live of saved listings in seconds
+    :param locate_cache_path: Path to a json file where locations of resources are saved (optional)
+    :param locate_workers: Number of simultaneous vortex 'locate' requests
     """
-    model_names = get_model_names(get_variable_instances(model, variables))
+    iterator = list(iterator)
     listfiles = []
     notfound = []
-    for member in members:
-        for model_name in model_names:
-            reader = AromeHendrixReader(
-                model=model_name, getmode='locate', member=member)
-            model_list_files, model_not_found = reader.get_file_list(iterator)
+    ftp_pool = FTPSessionPool()
+    listing_cache = DirectoryListingCache(listing_cache_path, listing_cache_ttl)
+    locate_cache = VortexLocateCache(locate_cache_path)
+    try:
+        for reader in get_prestaging_readers(model, variables, members):
+            model_list_files, model_not_found = reader.get_file_list(
+                iterator, ftp_pool, listing_cache, locate_cache, locate_workers)
             listfiles += model_list_files
             notfound += model_not_found
+    finally:
+        ftp_pool.close()
+        listing_cache.save()
+        locate_cache.save()
     return listfiles, notfound
 
 
+def get_prestaging_readers(model, variables, members, folderLayout=None):
+    """
+    Readers locating native files on Hendrix, one for each model and member extracted.
+
+    :param model: Model name
+    :param variables: Computed variables names
+    :param members: List of members, or 'all' for all members listed in config/models.ini.
+    :param folderLayout: FolderLayout, necessary to download files in _native_.
+    """
+    model_names = get_model_names(get_variable_instances(model, variables))
+    members = get_members(members, model_names)
+    return [AromeHendrixReader(folderLayout, model=model_name, getmode='locate', member=member)
+            for member in members
+            for model_name in model_names]
+
+
 def get_prestaging_file_list(config_user):
     """
     Prepare a list with the content of a prestaging file.
 
+    Listings of Hendrix folders are saved in the work folder for config_user['listing_cache_ttl'] seconds
+    (default: one day). Locations of resources given by vortex are saved in the work folder too,
+    and are resolved by config_user['locate_workers'] threads (default 4).
+
     :param config_user: Dictionary containing the configuration as given by the user.
     """
     c = DictNamespace(config_user)
     iterator = TimeIterator(config_user).get_iterator()
+    work_folder = c.get('work_folder', None)
+    listing_cache_path = os.path.join(work_folder, "hendrix_listings.json") if work_folder else None
+    locate_cache_path = os.path.join(work_folder, "vortex_locations.json") if work_folder else None
 
     return _get_prestaging_file_list(
         iterator,
         c.get('model', None),
         c.variables,
-        c.get('members', [None])
+        c.get('members', [None]),
+        listing_cache_path=listing_cache_path,
+        listing_cache_ttl=c.get('listing_cache_ttl', 86400),
+        locate_cache_path=locate_cache_path,
+        locate_workers=c.get('locate_workers', 4)
+    )
+
+
+def _ingest_prestaged_files(
+        iterator,
+        model,
+        variables,
+        members,
+        work_folder,
+        ftp_workers=4,
+        listing_cache_ttl=None,
+        locate_workers=4):
+    """
+    Download in _native_ all native files of an extraction, once they are prestaged on Hendrix.
+
+    Files are transferred by FTP in ftp_workers persistent sessions, instead of one vortex request for each file.
+
+    :param iterator: Iterator on (date, term)
+    :param model: Model name
+    :param variables: Computed variables names
+    :param members: List of members, or 'all' for all members listed in config/models.ini.
+    :param work_folder: Path to main folder where extraction is done
+    :param ftp_workers: Number of simultaneous FTP transfers
+    :param listing_cache_ttl: Time to live of saved listings in seconds
+    :param locate_workers: Number of simultaneous vortex 'locate' requests
+    """
+    layout = FolderLayout(work_folder=work_folder)
+    ftp_pool = FTPSessionPool(size=ftp_workers)
+    listing_cache = DirectoryListingCache(os.path.join(work_folder, "hendrix_listings.json"), listing_cache_ttl)
+    locate_cache = VortexLocateCache(os.path.join(work_folder, "vortex_locations.json"))
+    try:
+        filepaths, notfound = ingest_native_files(
+            get_prestaging_readers(model, variables, members, layout),
+            iterator, ftp_pool, listing_cache, locate_cache, locate_workers)
+    finally:
+        ftp_pool.close()
+        listing_cache.save()
+        locate_cache.save()
+    logger.info(f"[CONFIG READER] {len(filepaths)} native files ingested, {len(notfound)} not found on Hendrix")
+    return filepaths, notfound
+
+
+def ingest_prestaged_files(config_user):
+    """
+    Download in _native_ all native files of an extraction, once they are prestaged on Hendrix.
+
+    To be used after prestage(config_user), once the email of the Hendrix team is received.
+    execute(config_user) then uses the downloaded files. config_user['ftp_workers'] gives
+    the number of simultaneous FTP transfers (default 4).
+
+    :param config_user: Dictionary containing the configuration as given by the user.
+    """
+    c = DictNamespace(config_user)
+    return _ingest_prestaged_files(
+        TimeIterator(config_user).get_iterator(),
+        c.get('model', None),
+        c.variables,
+        c.get('members', [None]),
+        c.work_folder,
+        ftp_workers=c.get('ftp_workers', 4),
+        listing_cache_ttl=c.get('listing_cache_ttl', 86400),
+        locate_workers=c.get('locate_workers', 4)
+    )
+
+
+def start_prestaging_pipeline(config_user):
+    """
+    Submit prestaging requests on Hendrix, then download native files in the background as soon as they are
+    prestaged (see PrestagingPipeline).
+
+    Optional keys of config_user: prestaging_chunk_size (maximum number of files in a request, default 500),
+    prestaging_poll_interval (time in seconds between two checks of the requests, default 600),
+    prestaging_file_polls (number of checks of the files of a consumed request, default 6),
+    prestaging_request_polls (number of checks of a request before its files are left to vortex, default 144),
+    ftp_workers (number of simultaneous FTP transfers, default 4).
+
+    :param config_user: Dictionary containing the configuration as given by the user.
+    :return: PrestagingPipeline, whose method wait(date, term) returns once files of (date, term) are downloaded.
+    """
+    c = DictNamespace(config_user)
+    work_folder = c.work_folder
+    layout = FolderLayout(work_folder=work_folder)
+    ftp_pool = FTPSessionPool(size=c.get('ftp_workers', 4))
+    listing_cache = DirectoryListingCache(os.path.join(work_folder, "hendrix_listings.json"),
+                                          c.get('listing_cache_ttl', 86400))
+    locate_cache = VortexLocateCache(os.path.join(work_folder, "vortex_locations.json"))
+    try:
+        files_by_step, notfound = locate_native_files_by_step(
+            get_prestaging_readers(c.get('model', None), c.variables, c.get('members', [None]), layout),
+            TimeIterator(config_user).get_iterator(), ftp_pool, listing_cache, locate_cache,
+            c.get('locate_workers', 4))
+    finally:
+        listing_cache.save()
+        locate_cache.save()
+    if notfound:
+        logger.warning(f"[CONFIG READER] {len(notfound)} resources not found on Hendrix")
+
+    name_str = c.email_address.split("@")[0].replace('.', '_')
+    pipeline = PrestagingPipeline(
+        ftp_pool,
+        files_by_step,
+        f"prestaging_{name_str}_{c.model}_ID_{str(uuid.uuid1())[:5]}",
+        c.email_address,
+        chunk_size=c.get('prestaging_chunk_size', 500),
+        poll_interval=c.get('prestaging_poll_interval', 600),
+        max_file_polls=c.get('prestaging_file_polls', 6),
+        max_request_polls=c.get('prestaging_request_polls', 144)
     )
+    pipeline.start()
+    return pipeline
 
 
 def _prestage(
@@ -423,9 +749,7 @@ def _prestage(
     filepath = os.path.join(layout.work_folder, name_txt_file)
 
     with open(filepath, 'w') as fp:
-        fp.write(f"#MAIL={email_address}\n")
-        for element in listfiles:
-            fp.write(element + "\n")
+        fp.write(prestaging_request_content(listfiles, email_address))
 
     print("\n\nPlease find below the procedure for prestaging. \
         Note a new file named 'request_prestaging_*.txt' has been created on your current folder\n\n1. \
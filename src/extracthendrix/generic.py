@@ -2,17 +2,24 @@ import os
 import copy
 import logging
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import glob
 import shutil
 import uuid
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
+import dask
+import dask.array as da
 import epygram
 import xarray as xr
+import netCDF4
 from extracthendrix.hendrix_emails import send_problem_extraction_email, send_script_stopped_email
 
-from extracthendrix.readers import AromeHendrixReader
+from extracthendrix.readers import AromeHendrixReader, download_native_files, get_members
+from extracthendrix.journal import file_is_done
 from extracthendrix.config.domains import domains_descriptions
 from extracthendrix.exceptions import CanNotReadEpygramField
 from extracthendrix.config.variables import arome, pearome, arome_analysis, arome_analysis_p0, arome_analysis_p1, arpege, arpege_analysis_4dvar, pearp
@@ -74,6 +81,327 @@ class FolderLayout:
             shutil.rmtree(getattr(self, subfolder))
 
 
+class SubgridIndexCache:
+    """
+    Stores indices (i1, i2, j1, j2) of the subgrid of a geographical domain on the grid of a model.
+
+    Computing these indices from lat/lon coordinates (ll2ij) is the same for all fields, terms and dates of a model.
+    Indices are computed once per (geometry, domain) and saved in a json file in the work folder,
+    so that later extractions don't compute them again.
+
+    Indices are only reused by extractions in the same work folder: an extraction in another work folder
+    computes them again, even for the same grid and domain (this costs two calls to ll2ij per domain and grid).
+
+    :param filepath: Path to the json file where indices are stored. If None, indices are only kept in memory.
+    :type filepath: str
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.indices = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read indices saved by previous extractions"""
+        if self.filepath and os.path.isfile(self.filepath):
+            with open(self.filepath, 'r') as f:
+                self.indices = json.load(f)
+
+    def save(self):
+        """Write indices to the json file"""
+        if self.filepath:
+            tmp_filepath = f"{self.filepath}.{uuid.uuid4().hex[:5]}.tmp"
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.indices, f, indent=1)
+            os.replace(tmp_filepath, self.filepath)
+
+    @staticmethod
+    def get_key(model_name, geometry, domain):
+        """
+        Key of a (geometry, domain) combination.
+
+        :param model_name: Model name
+        :param geometry: Epygram geometry
+        :param domain: Geographical domain name
+        :return: str
+        """
+        domain_description = domains_descriptions[domain]
+        corners = [domain_description[key] for key in ['lon_llc', 'lat_llc', 'lon_urc', 'lat_urc']]
+        dimensions = [geometry.dimensions.get(key) for key in ['X', 'Y']]
+        return "|".join(str(element) for element in [model_name, geometry.name, *dimensions, domain, *corners])
+
+    @staticmethod
+    def compute_indices(geometry, domain):
+        """
+        Compute indices of a domain on a grid using lat/lon of the lower left and upper right corners.
+
+        :param geometry: Epygram geometry
+        :param domain: Geographical domain name
+        :return: list [i1, i2, j1, j2]
+        """
+        domain_description = domains_descriptions[domain]
+        i1, j1 = np.round(geometry.ll2ij(
+            domain_description['lon_llc'], domain_description['lat_llc'])) + 1
+        i2, j2 = np.round(geometry.ll2ij(
+            domain_description['lon_urc'], domain_description['lat_urc'])) + 1
+        return [int(i1), int(i2), int(j1), int(j2)]
+
+    def get_indices(self, model_name, geometry, domain):
+        """
+        Return indices of a domain, computing them only if they are not already known.
+
+        :param model_name: Model name
+        :param geometry: Epygram geometry
+        :param domain: Geographical domain name
+        :return: list [i1, i2, j1, j2]
+        """
+        key = self.get_key(model_name, geometry, domain)
+        with self.lock:
+            if key not in self.indices:
+                self.indices[key] = self.compute_indices(geometry, domain)
+                logger.debug(f"[CACHE MANAGER] Subgrid indices for {key}: {self.indices[key]}")
+                self.save()
+            return self.indices[key]
+
+
+class OpenedFilesCache:
+    """
+    Least recently used store of opened netcdf files (xarray datasets).
+
+    The number of opened files and their size are bounded: when a limit is exceeded,
+    the least recently used dataset is closed and forgotten. Hits and misses are counted to help choosing limits.
+
+    :param max_files: Maximum number of opened files. None means no limit.
+    :type max_files: int
+    :param max_bytes: Maximum size (in bytes) of opened files. None means no limit.
+    :type max_bytes: int
+    """
+
+    def __init__(self, max_files=64, max_bytes=None):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.datasets = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, filepath):
+        return filepath in self.datasets
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def get(self, filepath):
+        """
+        Return an opened dataset and mark it as recently used, or None if the file is not opened.
+
+        :param filepath: Path to file
+        :return: xarray dataset or None
+        """
+        if filepath in self.datasets:
+            self.hits += 1
+            self.datasets.move_to_end(filepath)
+            return self.datasets[filepath]
+        self.misses += 1
+        return None
+
+    def put(self, filepath, dataset):
+        """
+        Store an opened dataset and close least recently used datasets if limits are exceeded.
+
+        :param filepath: Path to file
+        :param dataset: xarray dataset
+        """
+        if filepath in self.datasets:
+            self.close(filepath)
+        self.datasets[filepath] = dataset
+        self.nbytes += dataset.nbytes
+        while len(self.datasets) > 1 and self.is_full():
+            oldest_filepath = next(iter(self.datasets))
+            self.close(oldest_filepath)
+            self.evictions += 1
+
+    def is_full(self):
+        """True if the number or the size of opened files exceeds limits"""
+        too_many_files = self.max_files is not None and len(self.datasets) > self.max_files
+        too_many_bytes = self.max_bytes is not None and self.nbytes > self.max_bytes
+        return too_many_files or too_many_bytes
+
+    def close(self, filepath):
+        """
+        Close a dataset and forget it.
+
+        :param filepath: Path to file
+        """
+        dataset = self.datasets.pop(filepath, None)
+        if dataset is not None:
+            self.nbytes -= dataset.nbytes
+            dataset.close()
+
+    def clear(self):
+        """Close all datasets"""
+        for filepath in list(self.datasets):
+            self.close(filepath)
+
+    def stats(self):
+        """Return counters as a dictionary"""
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    opened_files=len(self.datasets),
+                    nbytes=self.nbytes)
+
+
+class PreviousTermWindow:
+    """
+    Keeps in memory native arrays read for the current and the previous time step.
+
+    Decumulation functions (e.g. compute_decumul) need the value of the previous term: arrays read during the
+    previous time step are returned from memory instead of being read again in cache.
+    """
+
+    def __init__(self):
+        self.previous_step = None
+        self.current_step = None
+        self.previous = defaultdict(dict)
+        self.current = defaultdict(dict)
+
+    def roll(self, date, term):
+        """
+        Start a new time step: arrays of the current time step become arrays of the previous time step.
+
+        :param date: Run date
+        :param term: Forecast lead time
+        """
+        if (date, term) == self.current_step:
+            return
+        self.previous_step, self.previous = self.current_step, self.current
+        self.current_step, self.current = (date, term), defaultdict(dict)
+
+    def get(self, date, term, domain, outname):
+        """
+        Return an array of the previous time step, or None if it is not in the window.
+
+        :param date: Run date
+        :param term: Forecast lead time
+        :param domain: Geographical domain
+        :param outname: Name of the native variable in cache
+        """
+        if (date, term) == self.previous_step:
+            return self.previous[domain].get(outname)
+        return None
+
+    def store(self, date, term, domain, outname, data):
+        """
+        Remember an array read during the current time step.
+
+        :param date: Run date
+        :param term: Forecast lead time
+        :param domain: Geographical domain
+        :param outname: Name of the native variable in cache
+        :param data: xarray DataArray
+        """
+        if (date, term) == self.current_step:
+            self.current[domain][outname] = data
+
+
+class ReadCacheMemo:
+    """
+    Remembers native arrays read during the computation of one time step (member, date, term, domain).
+
+    Several computed variables use the same native variables (e.g. "Wind" and "Wind_DIR" both use wind components):
+    each native array is read in cache only once per time step.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, read_cache):
+        """
+        Return a read_cache function that first looks in the memo.
+
+        :param read_cache: read_cache method of a cache manager
+        :return: function with the same signature as read_cache
+        """
+        def memoized_read_cache(date, term, domain, native_variable):
+            key = (native_variable.model_name, native_variable.outname, date, term, domain)
+            if key in self.arrays:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.arrays[key] = read_cache(date, term, domain, native_variable)
+            return self.arrays[key]
+        return memoized_read_cache
+
+
+class TimeSteps:
+    """
+    Several time steps (date, term) computed at once (compute_mode='batch').
+
+    An instance is given as "term" to post-processing functions, so that they are applied once
+    on (time, yy, xx) arrays. Subtracting an integer shifts terms, which is used for decumulation:
+    a term lower than 1 is replaced by None and the corresponding value is 0 (see StackedReadCache).
+    """
+
+    def __init__(self, steps):
+        """
+        :param steps: List of (date, term)
+        """
+        self.steps = list(steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __sub__(self, delta):
+        return TimeSteps([(step[0], step[1] - delta) if step is not None and step[1] - delta > 0 else None
+                          for step in self.steps])
+
+    def validity_dates(self):
+        """Return validity dates of time steps"""
+        return [validity_date(date, term) for date, term in self.steps]
+
+
+class StackedReadCache:
+    """
+    Stacks arrays read in cache for several time steps into a (time, yy, xx) array.
+
+    Arrays are read with a memoized read_cache (see ReadCacheMemo), so that a time step shared
+    by several stacks (e.g. terms t and t-1 for decumulation) is read only once.
+    """
+
+    def __init__(self, read_cache):
+        """
+        :param read_cache: read_cache method of a cache manager
+        """
+        self.read_cache = read_cache
+
+    def __call__(self, date, term, domain, native_variable):
+        """
+        :param date: Not used, dates are in term
+        :param term: TimeSteps
+        :param domain: Geographical domain
+        :param native_variable: native variable
+        :return: xarray DataArray with dimensions (time, yy, xx)
+        """
+        arrays = [self.read_cache(step[0], step[1], domain, native_variable) if step is not None else None
+                  for step in term]
+        template = next(array for array in arrays if array is not None)
+        arrays = [array if array is not None else xr.zeros_like(template) for array in arrays]
+        # No time coordinate: arrays of shifted time steps are combined by position
+        return xr.concat(arrays, dim='time')
+
+
+# Libraries decoding native files (FA, GRIB) through epygram are not thread-safe
+NATIVE_DECODING_LOCK = threading.Lock()
+
+
 class AromeCacheManager:
     """
     A class that deals with data in cache and eventually triggers downloading.
@@ -88,7 +416,16 @@ class AromeCacheManager:
             model=None,
             delete_native=True,
             member=None,
-            autofetch_native=False
+            autofetch_native=False,
+            single_pass_domains=False,
+            subgrid_indices=None,
+            max_opened_files=64,
+            max_opened_bytes=None,
+            shared_store=None,
+            lazy=False,
+            chunks=None,
+            dtype=None,
+            journal=None
     ):
         """
         :param folderLayout: instance of the class FolderLayout. Gives information about the working directory.
@@ -105,16 +442,58 @@ class AromeCacheManager:
         :param autofetch_native: Raises an exception if False, for testing purposes, because extraction on Hendrix
         is slow
         :type autofetch_native: Bool
+        :param single_pass_domains: Extract all domains in a single pass on the native file.
+        :type single_pass_domains: Bool
+        :param subgrid_indices: Indices of domains on model grids, shared between cache managers.
+        :type subgrid_indices: SubgridIndexCache
+        :param max_opened_files: Maximum number of netcdf files in cache kept opened.
+        :type max_opened_files: int
+        :param max_opened_bytes: Maximum size of netcdf files in cache kept opened.
+        :type max_opened_bytes: int
+        :param shared_store: Store of native files shared between extractions.
+        :type shared_store: SharedNativeStore
+        :param lazy: read_cache returns dask arrays instead of loading data. Files in cache stay opened
+        until forget_opened_files is called.
+        :type lazy: Bool
+        :param chunks: Chunks of files in cache when lazy is True (default: one chunk per file).
+        :type chunks: dict
+        :param dtype: "32bits" to store fields in cache, and compute variables, in float32.
+        :type dtype: str
+        :param journal: Journal of files done, checked instead of the file system (optional).
+        :type journal: WorkJournal
         """
         self.folderLayout = folderLayout
         self.delete_native = delete_native
         self.coordinates = ['latitude', 'longitude']
-        self.extractor = AromeHendrixReader(folderLayout, model, member)
+        self.extractor = AromeHendrixReader(folderLayout, model, member, shared_store=shared_store, journal=journal)
+        self.journal = journal
         self.domain = domain
         self.native_variables = native_variables
         self.alternative_names = alternative_names
         self.autofetch_native = autofetch_native
-        self.opened_files = {}
+        self.single_pass_domains = single_pass_domains
+        if subgrid_indices is None:
+            subgrid_indices = SubgridIndexCache(self.get_path_subgrid_indices())
+        self.subgrid_indices = subgrid_indices
+        self.lazy = lazy
+        self.chunks = chunks if chunks is not None else {}
+        self.dtype = dtype
+        if self.lazy:
+            # Lazy arrays need their file until they are computed: files are never closed by the LRU
+            # (xarray itself bounds the number of file handles)
+            max_opened_files, max_opened_bytes = None, None
+        self.opened_files = OpenedFilesCache(max_files=max_opened_files, max_bytes=max_opened_bytes)
+        self.term_window = PreviousTermWindow()
+        # Domains can be computed in several threads (see ComputedValues.domain_workers): self.lock protects
+        # opened files and arrays in memory, files of a time step are put in cache by one thread at a time
+        self.lock = threading.RLock()
+        self.time_step_locks = defaultdict(threading.Lock)
+        # Time steps whose native file was read, deleted by delete_native_files
+        self.native_steps_read = set()
+
+    def get_path_subgrid_indices(self):
+        """Return path of the json file storing subgrid indices, in the work folder"""
+        return os.path.join(self.folderLayout.work_folder, "subgrid_indices.json")
 
     # old get_cache_path
     def get_path_file_in_cache(self, date, term, domain):
@@ -143,11 +522,8 @@ class AromeCacheManager:
         """
         domain_description = domains_descriptions[domain]
         if self.extractor.model_name not in ['AROME', 'AROME_SURFACE']:
-            i1, j1 = np.round(field.geometry.ll2ij(
-                domain_description['lon_llc'], domain_description['lat_llc'])) + 1
-            i2, j2 = np.round(field.geometry.ll2ij(
-                domain_description['lon_urc'], domain_description['lat_urc'])) + 1
-            field = field.extract_subarray(int(i1), int(i2), int(j1), int(j2))
+            i1, i2, j1, j2 = self.subgrid_indices.get_indices(self.extractor.model_name, field.geometry, domain)
+            field = field.extract_subarray(i1, i2, j1, j2)
         else:
             field = field.extract_subarray(
                 domain_description['first_i'],
@@ -217,10 +593,37 @@ class AromeCacheManager:
         :param term: forecast lead time
         :return: path of the native file, Epygram resource
         """
-        native_file_path = self.extractor.get_native_file(date, term, autofetch=self.autofetch_native)
+        native_file_path = self.get_native_file(date, term)
         input_resource = epygram.formats.resource(native_file_path, 'r', fmt=self.extractor.fmt.upper())
         return native_file_path, input_resource
 
+    def get_native_file(self, date, term):
+        """
+        Download the native file if necessary, and remember that it is read so that it is deleted
+        by delete_native_files (e.g. the native file of the previous term, read for decumulation).
+
+        :param date: Run date
+        :param term: Forecast lead time
+        :return: path of the native file
+        """
+        native_file_path = self.extractor.get_native_file(date, term, autofetch=self.autofetch_native)
+        with self.lock:
+            self.native_steps_read.add((date, term))
+        return native_file_path
+
+    def get_domains_to_put_in_cache(self, domain):
+        """
+        Domains written in cache when the cache file of a domain is missing.
+
+        In single pass mode, all domains of the cache manager are extracted at once from the native file.
+
+        :param domain: Geographical domain name
+        :return: list of domains
+        """
+        if self.single_pass_domains and isinstance(self.domain, list) and domain in self.domain:
+            return self.domain
+        return [domain]
+
     def put_in_cache(self, date, term, domain):
         """
         Creates a netcdf file for each forecast lead time or analysis date,
@@ -228,6 +631,9 @@ class AromeCacheManager:
 
         This permits to store intermediate data and to easily relaunch extraction if necessary.
 
+        In single pass mode (single_pass_domains=True), each field is read and converted (sp2gp) only once
+        and the cache files of all domains are written from the same field.
+
         :param date: Run date
         :param term: Forecast leadtime
         :param domain: Geographical domain name
@@ -235,20 +641,27 @@ class AromeCacheManager:
         #this way the cache manager wouldn't depend on the file's format
         """
 
-        # Check if file is already in cache
-        filepath_in_cache = self.get_path_file_in_cache(date, term, domain)
-        if os.path.isfile(filepath_in_cache) and self.autofetch_native:
+        # Check if files are already in cache
+        filepaths_in_cache = {}
+        for domain_to_extract in self.get_domains_to_put_in_cache(domain):
+            filepath_in_cache = self.get_path_file_in_cache(date, term, domain_to_extract)
+            if not (file_is_done(self.journal, 'cache', filepath_in_cache) and self.autofetch_native):
+                filepaths_in_cache[domain_to_extract] = filepath_in_cache
+        if not filepaths_in_cache:
             return
 
         # Download file on Hendrix if necessary
         native_file_path, input_resource = self.get_native_resource_if_necessary(date, term)
         logger.debug(self.native_variables)
 
-        # Initialize netcdf file
-        output_resource = epygram.formats.resource(
-            filepath_in_cache, 'w', fmt='netCDF')
-        output_resource.behave(
-            N_dimension='Number_of_points', X_dimension='xx', Y_dimension='yy')
+        # Initialize netcdf files
+        output_resources = {}
+        for domain_to_extract, filepath_in_cache in filepaths_in_cache.items():
+            output_resource = epygram.formats.resource(
+                filepath_in_cache, 'w', fmt='netCDF')
+            output_resource.behave(
+                N_dimension='Number_of_points', X_dimension='xx', Y_dimension='yy')
+            output_resources[domain_to_extract] = output_resource
 
         # Extract variable from native file (i.e. .fa or .grib)
         for variable in self.native_variables:
@@ -256,12 +669,20 @@ class AromeCacheManager:
             field = self.pass_metadata_to_netcdf(field, variable.outname)
             if field.spectral:
                 field.sp2gp()
-            field = self.extract_subgrid(field, domain)
-            output_resource.writefield(field)
-        logger.debug(f"[CACHE MANAGER] {self.extractor.fmt.upper()} file extracted and saved in cache for date {date}, "
-                     f"term {term}, "
-                     f"domain {domain}.")
-        logger.debug(f"Filepath: {filepath_in_cache}")
+            if self.dtype == "32bits":
+                field.setdata(field.getdata().astype(np.float32))
+            for domain_to_extract, output_resource in output_resources.items():
+                output_resource.writefield(self.extract_subgrid(field, domain_to_extract))
+
+        for domain_to_extract, output_resource in output_resources.items():
+            output_resource.close()
+            if self.journal is not None:
+                self.journal.record('cache', filepaths_in_cache[domain_to_extract])
+            logger.debug(f"[CACHE MANAGER] {self.extractor.fmt.upper()} file extracted and saved in cache for date {date}, "
+                         f"term {term}, "
+                         f"domain {domain_to_extract}.")
+            logger.debug(f"Filepath: {filepaths_in_cache[domain_to_extract]}")
+        input_resource.close()
 
     def get_file_in_cache(self, filepath):
         """
@@ -271,37 +692,73 @@ class AromeCacheManager:
         :param filepath: Path to file
         :return: xarray dataset
         """
-        if filepath not in self.opened_files:
-            self.open_and_store_file(filepath)
-        return self.opened_files[filepath]
+        dataset = self.opened_files.get(filepath)
+        if dataset is None:
+            dataset = self.open_and_store_file(filepath)
+        return dataset
 
     def open_and_store_file(self, filepath):
         """
         Open netcdf file in cache folder as a xarray dataset.
 
         :param filepath: Path to file
+        :return: xarray dataset
         """
-        dataset = xr.open_dataset(filepath)
+        if self.lazy:
+            dataset = xr.open_dataset(filepath, chunks=self.chunks)
+        else:
+            dataset = xr.open_dataset(filepath)
         dataset = dataset.set_coords(self.coordinates)
-        self.opened_files[filepath] = dataset
+        self.opened_files.put(filepath, dataset)
+        return dataset
 
     def forget_opened_files(self):
-        """Reinitialize dictionary that stored opened netcdf files in cache to release RAM."""
-        self.opened_files = {}
+        """Close netcdf files opened in cache to release RAM and file descriptors."""
+        logger.debug(f"[CACHE MANAGER] Opened files in cache {self.extractor.model_name}: {self.opened_files.stats()}")
+        self.opened_files.clear()
 
     def close_file(self, date, term, domain):
-        """Not used"""
+        """
+        Close a netcdf file opened in cache.
+
+        :param date: Run date
+        :param term: Forecast lead time
+        :param domain: Geographical domain
+        """
         filepath = self.get_path_file_in_cache(date, term, domain)
-        file = self.opened_files[filepath]
-        file['dataset'].close()
-        del self.opened_files[filepath]
+        self.opened_files.close(filepath)
+
+    def delete_native_files(self, date=None, term=None):
+        """
+        Delete .fa or .grib files (i.e. native files) after extraction of desired variables
+
+        If date is given, only the native file of this date/term and native files read since the last call
+        (e.g. the previous term, read for decumulation) are deleted, so that files downloaded in advance
+        (see NativeFilePrefetcher) are kept.
 
-    def delete_native_files(self):
-        """Delete .fa or .grib files (i.e. native files) after extraction of desired variables"""
+        Lock files and files being downloaded are never deleted: another thread or process may be using them
+        (see AromeHendrixReader.get_native_file). They are deleted with the folder at the end of the extraction.
+
+        :param date: Run date
+        :param term: Forecast lead time
+        """
+        with self.lock:
+            steps = self.native_steps_read | {(date, term)}
+            self.native_steps_read = set()
         if self.delete_native:
-            files = glob.glob(f'{self.folderLayout._native_}/*')
+            if date is not None:
+                files = [f for step in steps for f in glob.glob(self.extractor.get_path_file_in_native(*step))]
+            else:
+                files = [f for f in glob.glob(f'{self.folderLayout._native_}/*')
+                         if not f.endswith(('.lock', '.part', '.tmp'))]
             for f in files:
                 os.remove(f)
+            if self.journal is not None:
+                if date is not None:
+                    for f in files:
+                        self.journal.forget('native', f)
+                else:
+                    self.journal.forget('native')
 
     def read_cache(self, date, term, domain, native_variables):
         """
@@ -313,24 +770,250 @@ class AromeCacheManager:
         :param native_variables: Name of native variable to read
         :return: Data as a xarray dataset
         """
-        # Check file in cache and download if necessary
+        # Arrays of the previous time step are already in memory
+        with self.lock:
+            data = self.term_window.get(date, term, domain, native_variables.outname)
+            time_step_lock = self.time_step_locks[(date, term)]
+        if data is not None:
+            return data
+
+        # Check file in cache and download if necessary (other domains and time steps are not blocked)
         filepath_in_cache = self.get_path_file_in_cache(date, term, domain)
-        file_is_not_in_cache = not os.path.isfile(filepath_in_cache)
-        if file_is_not_in_cache:
-            logger.debug(f"[CACHE MANAGER] {native_variables.name}: "
-                         f"{date}, "
-                         f"term {term}, "
-                         f"domain {domain} NOT in cache")
-            self.put_in_cache(date, term, domain)
-        else:
-            logger.debug(f"[CACHE MANAGER] {native_variables.name}: "
-                         f"{date}, "
-                         f"term {term}, "
-                         f"domain {domain} already in cache")
+        with time_step_lock:
+            file_is_not_in_cache = not file_is_done(self.journal, 'cache', filepath_in_cache)
+            if file_is_not_in_cache:
+                logger.debug(f"[CACHE MANAGER] {native_variables.name}: "
+                             f"{date}, "
+                             f"term {term}, "
+                             f"domain {domain} NOT in cache")
+                self.get_native_file(date, term)
+                with NATIVE_DECODING_LOCK:
+                    self.put_in_cache(date, term, domain)
+            else:
+                logger.debug(f"[CACHE MANAGER] {native_variables.name}: "
+                             f"{date}, "
+                             f"term {term}, "
+                             f"domain {domain} already in cache")
 
         # Return the file from cache
-        dataset = self.get_file_in_cache(filepath_in_cache)
-        return dataset[native_variables.outname]
+        with self.lock:
+            dataset = self.get_file_in_cache(filepath_in_cache)
+        data = dataset[native_variables.outname]
+        if self.dtype == "32bits" and data.dtype != np.float32:
+            # e.g. files in cache written by older versions of extracthendrix
+            data = data.astype(np.float32)
+        if not self.lazy:
+            # Data is loaded in memory since the file can be closed when other files are opened
+            # (xarray opens it again if it is closed by another thread meanwhile)
+            data = data.load()
+        with self.lock:
+            self.term_window.store(date, term, domain, native_variables.outname, data)
+        return data
+
+    def start_time_step(self, date, term):
+        """
+        Tell the cache manager that a new time step is computed, so that arrays of the previous time step
+        are kept in memory (see PreviousTermWindow).
+
+        :param date: Run date
+        :param term: Forecast lead time
+        """
+        with self.lock:
+            self.term_window.roll(date, term)
+            # Locks of time steps already put in cache
+            for date_and_term in [key for key in self.time_step_locks if key != (date, term)]:
+                if not self.time_step_locks[date_and_term].locked():
+                    del self.time_step_locks[date_and_term]
+
+
+# Names of coordinates and constant fields expected by SURFEX in forcing files
+SURFEX_COORDINATES = {"latitude": "LAT", "longitude": "LON"}
+FORC_TIME_STEP = 3600
+CO2AIR = 0.00062
+SURFEX_CONSTANT_FIELDS = ["CO2air", "Wind_DIR", "UREF", "ZREF", "slope", "aspect"]
+
+
+def make_dataset_surfex_compliant(ds):
+    """
+    Add necessary data for SURFEX to a dataset of computed variables.
+
+    Constant fields that depend on time (CO2air and, when absent, Wind_DIR) are lazy dask arrays
+    with one chunk per time step: they are never entirely held in memory.
+    Use get_surfex_encoding when saving the dataset so that they are compressed on disk.
+
+    :param ds: xarray dataset with dimensions (time, yy, xx)
+    :return: xarray dataset
+    """
+    # Rename Latitude and longitude
+    ds = ds.rename({name: surfex_name for name, surfex_name in SURFEX_COORDINATES.items() if name in ds.coords})
+
+    # Add forcing time step as an attribute
+    ds.attrs["FORC_TIME_STEP"] = FORC_TIME_STEP
+
+    # Add new variables: CO2air, UREF, ZREF, slope, aspect and FRC_TIME_STP
+    xx = len(ds.xx)
+    yy = len(ds.yy)
+    time = len(ds.time)
+    ds["CO2air"] = (("time", "xx", "yy"), da.full((time, xx, yy), CO2AIR, chunks=(1, xx, yy)))
+    if "Wind_DIR" not in ds:
+        ds["Wind_DIR"] = (("time", "xx", "yy"),
+                          da.zeros((time, xx, yy), chunks=(1, xx, yy)))
+    # Constant fields are floats, as in files written by NetcdfAppender
+    ds["UREF"] = (("xx", "yy"), np.full((xx, yy), 10.))
+    ds["ZREF"] = (("xx", "yy"), np.full((xx, yy), 2.))
+    ds["slope"] = (("xx", "yy"), np.zeros((xx, yy)))
+    ds["aspect"] = (("xx", "yy"), np.zeros((xx, yy)))
+    ds["FRC_TIME_STP"] = float(FORC_TIME_STEP)
+    return ds
+
+
+def get_surfex_encoding(ds):
+    """
+    Netcdf encoding of constant SURFEX fields: compressed, with one chunk per time step.
+
+    Wind_DIR is compressed even when it is computed, compression is lossless.
+
+    :param ds: xarray dataset returned by make_dataset_surfex_compliant
+    :return: dictionary to use as encoding in to_netcdf
+    """
+    encoding = {}
+    for name in SURFEX_CONSTANT_FIELDS:
+        if name in ds:
+            chunksizes = tuple(1 if dim == "time" else ds.sizes[dim] for dim in ds[name].dims)
+            encoding[name] = dict(zlib=True, chunksizes=chunksizes)
+    return encoding
+
+
+def cast_to_float32(ds):
+    """
+    Convert variables of a dataset to float32.
+
+    Fields are already in float32 when read in cache: only variables of another type (e.g. constant
+    fields added for SURFEX) are converted, the others are not copied.
+
+    :param ds: xarray dataset, not modified (e.g. datasets opened in cache)
+    :return: xarray dataset
+    """
+    return ds.assign({name: ds[name].astype(np.float32) for name in ds.data_vars
+                      if np.issubdtype(ds[name].dtype, np.number) and ds[name].dtype != np.float32})
+
+
+class NetcdfAppender:
+    """
+    Appends time steps to a netcdf file with an unlimited time dimension.
+
+    The file is written as "{filepath}.part" and renamed when closed, so that an incomplete file
+    is never considered as extracted (see ComputedValues.files_are_in_final).
+
+    :param filepath: Path to the final file.
+    :param dtype: "32bits" to save data in float32.
+    :param surfex: Write the file with the SURFEX layout (see make_dataset_surfex_compliant).
+    """
+    time_units = "hours since 1900-01-01 00:00:00"
+    calendar = "standard"
+
+    def __init__(self, filepath, dtype=None, surfex=False):
+        self.filepath = filepath
+        self.tmp_filepath = f"{filepath}.part"
+        self.dtype = dtype
+        self.surfex = surfex
+        self.dataset = None
+        self.time_indexes = {}
+        self.default_wind_dir = False
+
+    def get_dtype(self, dtype):
+        """Return dtype used in the file"""
+        return np.float32 if self.dtype == "32bits" else dtype
+
+    def get_name(self, name):
+        """Return name of a variable in the file"""
+        if self.surfex:
+            return SURFEX_COORDINATES.get(name, name)
+        return name
+
+    def create(self, arrays):
+        """
+        Create the netcdf file, using the first time step to define dimensions, coordinates and variables.
+
+        :param arrays: Dictionary of xarray DataArray (one for each computed variable)
+        """
+        if os.path.isfile(self.tmp_filepath):
+            # Incomplete file from an interrupted extraction
+            os.remove(self.tmp_filepath)
+        self.dataset = netCDF4.Dataset(self.tmp_filepath, 'w')
+        self.dataset.createDimension('time', None)
+        time = self.dataset.createVariable('time', 'f8', ('time',))
+        time.units = self.time_units
+        time.calendar = self.calendar
+
+        for array in arrays.values():
+            for dim, size in zip(array.dims, array.shape):
+                if dim not in self.dataset.dimensions:
+                    self.dataset.createDimension(dim, size)
+            for name, coord in array.coords.items():
+                if coord.dims and self.get_name(name) not in self.dataset.variables:
+                    variable = self.dataset.createVariable(self.get_name(name), coord.dtype, coord.dims)
+                    variable[:] = coord.values
+                    variable.setncatts(coord.attrs)
+
+        for name, array in arrays.items():
+            dtype = self.get_dtype(array.dtype)
+            fill_value = np.nan if np.issubdtype(dtype, np.floating) else None
+            variable = self.dataset.createVariable(name, dtype, ('time',) + array.dims, fill_value=fill_value)
+            variable.setncatts({key: value for key, value in array.attrs.items() if key != '_FillValue'})
+            coordinates = [self.get_name(coord) for coord in array.coords
+                           if array.coords[coord].dims and coord not in array.dims]
+            if coordinates:
+                variable.coordinates = " ".join(coordinates)
+
+        if self.surfex:
+            self.create_surfex_fields(arrays)
+
+    def create_surfex_fields(self, arrays):
+        """
+        Add necessary data for SURFEX: forcing time step and constant fields (see make_dataset_surfex_compliant).
+
+        :param arrays: Dictionary of xarray DataArray (one for each computed variable)
+        """
+        self.dataset.setncattr("FORC_TIME_STEP", FORC_TIME_STEP)
+        dtype = self.get_dtype(np.float64)
+        chunksizes = (1, len(self.dataset.dimensions["xx"]), len(self.dataset.dimensions["yy"]))
+        self.dataset.createVariable("CO2air", dtype, ("time", "xx", "yy"), zlib=True, chunksizes=chunksizes)
+        if "Wind_DIR" not in arrays:
+            self.default_wind_dir = True
+            self.dataset.createVariable("Wind_DIR", dtype, ("time", "xx", "yy"), zlib=True, chunksizes=chunksizes)
+        for name, value in [("UREF", 10), ("ZREF", 2), ("slope", 0), ("aspect", 0)]:
+            self.dataset.createVariable(name, dtype, ("xx", "yy"), zlib=True)[:] = value
+        self.dataset.createVariable("FRC_TIME_STP", dtype)[...] = FORC_TIME_STEP
+
+    def append(self, date, arrays):
+        """
+        Write one time step at the end of the file.
+
+        Writing the same date again (e.g. after a retry) overwrites it.
+
+        :param date: Validity date of the time step.
+        :param arrays: Dictionary of xarray DataArray (one for each computed variable)
+        """
+        if self.dataset is None:
+            self.create(arrays)
+        index = self.time_indexes.get(date, len(self.time_indexes))
+        for name, array in arrays.items():
+            self.dataset.variables[name][index, ...] = np.asarray(array)
+        if self.surfex:
+            self.dataset.variables["CO2air"][index, ...] = CO2AIR
+            if self.default_wind_dir:
+                self.dataset.variables["Wind_DIR"][index, ...] = 0
+        self.dataset.variables['time'][index] = netCDF4.date2num(date, self.time_units, self.calendar)
+        self.time_indexes[date] = index
+
+    def close(self):
+        """Close the file and give it its final name"""
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+            os.replace(self.tmp_filepath, self.filepath)
+            logger.debug(f"[COMPUTER] Saved file: {self.filepath}")
 
 
 def get_model_names(computed_vars):
@@ -398,6 +1081,81 @@ def get_variable_instances(model, computed_variables):
     return model_and_submodels
 
 
+# ComputedValues of a worker process of MemberProcessPool
+_member_computer = None
+
+
+def _init_member_worker(computer_kwargs):
+    """Create the ComputedValues (and the cache managers) owned by a worker process"""
+    global _member_computer
+    _member_computer = ComputedValues(**computer_kwargs)
+
+
+def _compute_member_in_worker(run, term, member):
+    result = _member_computer.compute_member(run, term, member)
+    # e.g. native file of the previous term, read for decumulation
+    _member_computer.delete_native_files(run, term)
+    return result
+
+
+def _forget_opened_files_in_worker():
+    for cache_manager in _member_computer.cache_managers.values():
+        cache_manager.forget_opened_files()
+
+
+class MemberProcessPool:
+    """
+    Computes members of an ensemble in separate processes.
+
+    Decoding native files and computing variables is CPU-bound and members are independent. Members are
+    distributed among worker processes once for all: each worker owns the cache managers of its members,
+    so that arrays of the previous time step stay in memory (see PreviousTermWindow). Computed values
+    are sent back to the main process, which writes final files.
+
+    :param computer_kwargs: Arguments of ComputedValues in worker processes (members excepted).
+    :param members: List of members.
+    :param workers: Number of worker processes.
+    """
+
+    def __init__(self, computer_kwargs, members, workers):
+        self.executors = []
+        self.executor_of_member = {}
+        workers = min(workers, len(members))
+        for index in range(workers):
+            members_of_worker = members[index::workers]
+            executor = ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_init_member_worker,
+                initargs=(dict(computer_kwargs, members=members_of_worker),))
+            self.executors.append(executor)
+            for member in members_of_worker:
+                self.executor_of_member[member] = executor
+        # Start processes now, before threads (e.g. downloads) are started in the main process
+        for executor in self.executors:
+            executor.submit(_forget_opened_files_in_worker).result()
+        logger.info(f"[COMPUTER] {workers} processes compute members {members}")
+
+    def compute(self, run, term, members):
+        """
+        Compute members simultaneously.
+
+        :return: dict {member: results of ComputedValues.compute_member}
+        """
+        futures = {member: self.executor_of_member[member].submit(_compute_member_in_worker, run, term, member)
+                   for member in members}
+        return {member: future.result() for member, future in futures.items()}
+
+    def forget_opened_files(self):
+        """Close files in cache opened by the workers"""
+        for future in [executor.submit(_forget_opened_files_in_worker) for executor in self.executors]:
+            future.result()
+
+    def shutdown(self):
+        """Stop worker processes"""
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+
 class ComputedValues:
     """
     Compute variables in cache and store computed values in netcdf format.
@@ -414,6 +1172,17 @@ class ComputedValues:
             members=[None],
             model=None,
             dtype=None,
+            single_pass_domains=False,
+            max_opened_files=64,
+            max_opened_bytes=None,
+            stream_final=False,
+            member_workers=4,
+            shared_store=None,
+            member_processes=0,
+            domain_workers=1,
+            lazy=False,
+            lazy_chunks=None,
+            journal=None,
     ):
         """
         :param folderLayout: instance of the class FolderLayout. Gives information about the working directory.
@@ -423,23 +1192,61 @@ class ComputedValues:
         :param computed_vars: Name of computed variables (e.g. "Tair" and not "CLSTEMPERATURE")
         :param autofetch_native: Raises an exception if False, for testing purposes, because extraction on Hendrix
         is slow.
-        :param members: Member number?
+        :param members: List of members, or 'all' for all members listed in config/models.ini.
         :param model: Model name.
+        :param dtype: "32bits" to save final files in float32.
+        :param single_pass_domains: Extract all domains in a single pass on the native file.
+        :param max_opened_files: Maximum number of netcdf files in cache kept opened by each cache manager.
+        :param max_opened_bytes: Maximum size of netcdf files in cache kept opened by each cache manager.
+        :param stream_final: Append each time step to the final file instead of saving files in _computed_.
+        :param member_workers: Number of simultaneous downloads of native files of the different members.
+        :param shared_store: SharedNativeStore, store of native files shared between extractions (optional).
+        :param member_processes: Number of processes computing members simultaneously (0: members are computed
+        one after the other in the current process).
+        :param domain_workers: Number of threads computing and writing domains simultaneously.
+        :param lazy: In compute_batch, build a dask graph from files in cache to final files, computed at once.
+        :param lazy_chunks: Chunks of files in cache when lazy is True (e.g. {'xx': 256, 'yy': 256}).
+        :param journal: WorkJournal of files done, checked instead of the file system when relaunching
+        an extraction (optional). Not used by member processes.
         """
         self.computed_vars = get_variable_instances(model, computed_vars)
-        self.members = members
         self.domain = domain
         self.delete_native = delete_native
         self.delete_computed_netcdf = delete_computed_netcdf
         self.models = get_model_names(self.computed_vars)
+        self.members = get_members(members, self.models)
+        self.member_workers = member_workers
+        self.shared_store = shared_store
+        self.autofetch_native = autofetch_native
         self.native_vars_by_model = sort_native_vars_by_model(
             self.computed_vars)
         self.computed_files = defaultdict(lambda: [])
         self.folderLayout = folderLayout
+        self.single_pass_domains = single_pass_domains
+        self.max_opened_files = max_opened_files
+        self.max_opened_bytes = max_opened_bytes
+        self.stream_final = stream_final
+        self.lazy = lazy
+        self.lazy_chunks = lazy_chunks
+        self.journal = journal
+        self.final_writers = {}
+        self.subgrid_indices = SubgridIndexCache(os.path.join(folderLayout.work_folder, "subgrid_indices.json"))
+        self.dtype = dtype
         self.cache_managers = self._cache_managers(
             folderLayout, self.computed_vars, autofetch_native)
         self.model = model
-        self.dtype = dtype
+        self.domain_workers = domain_workers
+        self.member_pool = None
+        if member_processes > 1 and len(self.members) > 1:
+            # Native files are downloaded by the main process, workers delete native files they read
+            self.member_pool = MemberProcessPool(
+                dict(folderLayout=folderLayout, delete_native=delete_native, domain=domain, computed_vars=computed_vars,
+                     autofetch_native=autofetch_native, model=model, dtype=dtype,
+                     single_pass_domains=single_pass_domains, max_opened_files=max_opened_files,
+                     max_opened_bytes=max_opened_bytes, stream_final=stream_final, shared_store=shared_store,
+                     domain_workers=domain_workers, lazy=lazy, lazy_chunks=lazy_chunks),
+                self.members,
+                member_processes)
 
     def _cache_managers(self, folderLayout, computed_vars, autofetch_native):
         """
@@ -460,7 +1267,16 @@ class ComputedValues:
                 model=model_name,
                 delete_native=self.delete_native,
                 autofetch_native=autofetch_native,
-                member=member
+                member=member,
+                single_pass_domains=self.single_pass_domains,
+                subgrid_indices=self.subgrid_indices,
+                max_opened_files=self.max_opened_files,
+                max_opened_bytes=self.max_opened_bytes,
+                shared_store=self.shared_store,
+                lazy=self.lazy,
+                chunks=self.lazy_chunks,
+                dtype=self.dtype,
+                journal=self.journal
             )
             for model_name, native_vars in sort_native_vars_by_model(computed_vars).items()
             for member in self.members
@@ -486,11 +1302,13 @@ class ComputedValues:
         """
         if self.computed_files[(member, domain)]:
             ds = xr.open_mfdataset(
-                self.computed_files[(member, domain)], concat_dim='time')
+                self.computed_files[(member, domain)], concat_dim='time', combine='nested')
+            ds = make_dataset_surfex_compliant(ds)
             if self.dtype == "32bits":
-                ds = ds.astype(np.float32)
+                ds = cast_to_float32(ds)
             filepath = self.get_path_file_in_final(time_tag, member, domain)
-            ds.to_netcdf(filepath)
+            ds.to_netcdf(filepath, unlimited_dims={"time": True}, encoding=get_surfex_encoding(ds))
+            self.record('final', filepath)
             logger.debug(f"[COMPUTER] Saved file: {filepath}")
         else:
             logger.info(
@@ -506,6 +1324,9 @@ class ComputedValues:
         if self.delete_computed_netcdf:
             self._delete_files_in_list_of_files(
                 self.computed_files[(member, domain)])
+            if self.journal is not None:
+                for filepath in self.computed_files[(member, domain)]:
+                    self.journal.forget('computed', filepath)
         if self.computed_files[(member, domain)]:
             del self.computed_files[(member, domain)]
 
@@ -519,22 +1340,62 @@ class ComputedValues:
 
         :param time_tag: Run time
         """
-        for member in self.members:
-            for domain in self.domain:
-                self._concat_files_and_save_netcdf(time_tag, member, domain)
-                self._delete_and_forget_computed_files(member, domain)
+        def concat_and_clean(member_and_domain):
+            member, domain = member_and_domain
+            if (member, domain) in self.final_writers:
+                self.final_writers.pop((member, domain)).close()
+                self.record('final', self.get_path_file_in_final(time_tag, member, domain))
+                return
+            self._concat_files_and_save_netcdf(time_tag, member, domain)
+            self._delete_and_forget_computed_files(member, domain)
+
+        self.map_domains(concat_and_clean, [(member, domain) for member in self.members for domain in self.domain])
+
+    def map_domains(self, function, items):
+        """
+        Apply a function to each domain (or each (member, domain)) in a pool of domain_workers threads.
+
+        Each domain has its own cache, computed and final files. Cache managers are shared between domains
+        and protect themselves with a lock.
+
+        :param function: Function taking an item as argument
+        :param items: List of domains, or of (member, domain)
+        :return: list of results, in the order of items
+        """
+        if self.domain_workers < 2 or len(items) < 2:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.domain_workers) as executor:
+            return list(executor.map(function, items))
+
+    def get_final_writer(self, time_tag, member, domain):
+        """
+        Return the writer appending time steps to the final file (stream_final=True).
+
+        :param time_tag: Time tag of the batch (see Grouper.filetag).
+        :param member: Member number.
+        :param domain: Geographical domain.
+        :return: NetcdfAppender
+        """
+        if (member, domain) not in self.final_writers:
+            filepath = self.get_path_file_in_final(time_tag, member, domain)
+            self.final_writers[(member, domain)] = NetcdfAppender(filepath, self.dtype, surfex=True)
+        return self.final_writers[(member, domain)]
 
     def delete_files_in_cache(self):
         """Delete files in _cache_ folder"""
         files = glob.glob(f'{self.folderLayout._cache_}/*')
         for f in files:
             os.remove(f)
+        if self.journal is not None:
+            self.journal.forget('cache')
 
     def clean_cache_folder(self):
         """Reinitialize dictionaries that stored opened netcdf files in cache to release RAM and delete files
         in _cache_ folder"""
         for cache_manager in self.cache_managers.values():
             cache_manager.forget_opened_files()
+        if self.member_pool is not None:
+            self.member_pool.forget_opened_files()
         self.delete_files_in_cache()
 
     # old get_file_hash
@@ -602,8 +1463,9 @@ class ComputedValues:
         computed_dataset = computed_dataset.expand_dims(
             dim='time').set_coords('time')
         if self.dtype == "32bits":
-            computed_dataset = computed_dataset.astype(np.float32)
+            computed_dataset = cast_to_float32(computed_dataset)
         computed_dataset.to_netcdf(filepath_computed)
+        self.record('computed', filepath_computed)
         logger.debug(f"[COMPUTER] Saved file: {filepath_computed}")
 
     def _move_files_to_domain_folders(self):
@@ -645,6 +1507,8 @@ class ComputedValues:
         """
         self._move_files_to_domain_folders()
         self._rename_final_folder()
+        if self.journal is not None:
+            self.journal.forget('final')
 
     def files_are_in_final(self, time_tag):
         """Check if files are already downloaded in _final folder for specific time (time_tag)"""
@@ -654,11 +1518,15 @@ class ComputedValues:
             for domain in self.domain:
                 path_file_in_final = self.get_path_file_in_final(
                     time_tag, member, domain)
-                files_in_final.append(os.path.isfile(path_file_in_final))
+                files_in_final.append(file_is_done(self.journal, 'final', path_file_in_final))
 
         return any(files_in_final)
 
-    def compute_variables_in_cache(self, computed_var, member, date, term, domain):
+    def get_readers(self):
+        """Returns Hendrix readers of all cache managers (one for each model and member)"""
+        return [cache_manager.extractor for cache_manager in self.cache_managers.values()]
+
+    def compute_variables_in_cache(self, computed_var, member, date, term, domain, memo=None):
         """
         Trigger computation in cache.
 
@@ -667,99 +1535,238 @@ class ComputedValues:
         :param date: Run time.
         :param term: Forecast lead time.
         :param domain: Geographical domain name.
+        :param memo: ReadCacheMemo shared by computed variables of the same time step.
         :return: xarray dataset.
         """
         # Parameters to read in cache
         model_name = self.get_model_name_from_computed_var(computed_var)
         read_cache_func = self.cache_managers[(model_name, member)].read_cache
+        if memo is not None:
+            read_cache_func = memo.wrap(read_cache_func)
         list_native_vars = computed_var.native_vars
 
         computed_values = computed_var.compute(read_cache_func, date, term, domain, *list_native_vars)
         return computed_values
 
-    def delete_native_files(self):
-        """Delete files in native folder."""
+    def delete_native_files(self, date=None, term=None):
+        """
+        Delete files in native folder.
+
+        :param date: Run date. If given, only native files of this date/term are deleted.
+        :param term: Forecast lead time.
+        """
         for cache_manager in self.cache_managers.values():
             # Delete .fa or .grib file after extraction of desired variables
-            cache_manager.delete_native_files()
-
-    def make_surfex_compliant(self):
-        """Add necessary data for SURFEX"""
-        for file in os.listdir(self.folderLayout._final_):
-            filename = os.path.join(self.folderLayout._final_, file)
-            ds = xr.open_dataset(filename)
-
-            # Rename Latitude and longitude
-            ds = ds.rename({"latitude": "LAT", "longitude": "LON"})
-
-            # Add forcing time step as an attribute
-            ds.attrs["FORC_TIME_STEP"] = 3600
-
-            # Add new variables: CO2air, UREF, ZREF, slope, aspect and FRC_TIME_STP
-            xx = len(ds.xx)
-            yy = len(ds.yy)
-            time = len(ds.time)
-            ds["CO2air"] = (("time", "xx", "yy"), np.full((time, xx, yy), 0.00062))
-            if "Wind_DIR" not in ds:
-                ds["Wind_DIR"] = (("time", "xx", "yy"),
-                                  np.zeros((time, xx, yy)))
-            ds["UREF"] = (("xx", "yy"), np.full((xx, yy), 10))
-            ds["ZREF"] = (("xx", "yy"), np.full((xx, yy), 2))
-            ds["slope"] = (("xx", "yy"), np.zeros((xx, yy)))
-            ds["aspect"] = (("xx", "yy"), np.zeros((xx, yy)))
-            ds["FRC_TIME_STP"] = 3600
-
-            # Save file to netcdf
+            cache_manager.delete_native_files(date, term)
+
+    def put_batch_in_cache(self, steps, prefetcher=None):
+        """
+        Put all time steps of a batch in cache, deleting native files after each time step.
+
+        :param steps: List of (date, term).
+        :param prefetcher: NativeFilePrefetcher, optional.
+        """
+        for index, (date, term) in enumerate(steps):
+            if prefetcher:
+                prefetcher.schedule(steps[index+1:])
+                prefetcher.wait(date, term)
+            members_not_in_cache = {
+                member for (model_name, member), cache_manager in self.cache_managers.items()
+                for domain in self.domain
+                if not file_is_done(self.journal, 'cache', cache_manager.get_path_file_in_cache(date, term, domain))}
+            self.download_native_files_of_members(date, term, members_not_in_cache)
+            for cache_manager in self.cache_managers.values():
+                for domain in self.domain:
+                    if not file_is_done(self.journal, 'cache', cache_manager.get_path_file_in_cache(date, term, domain)):
+                        cache_manager.put_in_cache(date, term, domain)
+            self.delete_native_files(date, term)
+
+    def compute_batch(self, steps, time_tag, prefetcher=None):
+        """
+        Compute all time steps of a batch (e.g. a day or a month) at once and save final files.
+
+        Native arrays are stacked into (time, yy, xx) arrays and post-processing functions are applied once,
+        instead of once per time step. No file is written in _computed_.
+
+        :param steps: List of (date, term) of the batch.
+        :param time_tag: Time tag of the batch (see Grouper.filetag).
+        :param prefetcher: NativeFilePrefetcher, optional.
+        """
+        self.put_batch_in_cache(steps, prefetcher)
+        time_steps = TimeSteps(steps)
+
+        def compute_and_save(member_and_domain):
+            member, domain = member_and_domain
+            filepath = self.get_path_file_in_final(time_tag, member, domain)
+            if file_is_done(self.journal, 'final', filepath):
+                return
+
+            memo = ReadCacheMemo()
+            variables_storage = {}
+            for computed_var in self.computed_vars:
+                model_name = self.get_model_name_from_computed_var(computed_var)
+                read_cache_func = StackedReadCache(memo.wrap(self.cache_managers[(model_name, member)].read_cache))
+                variables_storage[computed_var.name] = computed_var.compute(
+                    read_cache_func, None, time_steps, domain, *computed_var.native_vars)
+
+            dataset = xr.Dataset(variables_storage)
+            dataset = dataset.assign_coords(time=time_steps.validity_dates())
+            dataset = make_dataset_surfex_compliant(dataset)
             if self.dtype == "32bits":
-                ds = ds.astype(np.float32)
-            ds.to_netcdf(filename.split(".nc")[
-                         0]+"_tmp.nc", unlimited_dims={"time": True})
-            os.remove(filename)
-            os.rename(filename.split(".nc")[0]+"_tmp.nc", filename)
+                dataset = cast_to_float32(dataset)
+            if self.lazy:
+                # Files are written later, all at once. Files are created now: they are written as
+                # "{filepath}.part" so that a final file is never seen incomplete
+                return filepath, dataset.to_netcdf(f"{filepath}.part", unlimited_dims={"time": True},
+                                                   encoding=get_surfex_encoding(dataset), compute=False)
+            # Written as "{filepath}.part" so that a final file is never seen incomplete
+            dataset.to_netcdf(f"{filepath}.part", unlimited_dims={"time": True}, encoding=get_surfex_encoding(dataset))
+            os.replace(f"{filepath}.part", filepath)
+            self.record('final', filepath)
+            logger.debug(f"[COMPUTER] Batch {time_tag}, domain {domain}, {len(time_steps)} time steps computed "
+                         f"and saved: {filepath}")
+
+        writes = self.map_domains(compute_and_save,
+                                  [(member, domain) for member in self.members for domain in self.domain])
+
+        if self.lazy:
+            # A single task graph reads cache files, computes variables and writes final files of the batch:
+            # the scheduler overlaps I/O and computations, and memory is bounded by the size of chunks
+            writes = [write for write in writes if write is not None]
+            try:
+                dask.compute(*[delayed_write for filepath, delayed_write in writes])
+            except Exception:
+                for filepath, delayed_write in writes:
+                    if os.path.isfile(f"{filepath}.part"):
+                        os.remove(f"{filepath}.part")
+                raise
+            for filepath, delayed_write in writes:
+                os.replace(f"{filepath}.part", filepath)
+                self.record('final', filepath)
+            logger.debug(f"[COMPUTER] Batch {time_tag}, {len(writes)} files computed and saved")
+
+        # Native files read for decumulation of the first time step (files of the next batch downloaded
+        # in advance by the prefetcher are kept)
+        self.delete_native_files(*steps[-1])
+
+    def record(self, kind, filepath):
+        """Record a file written in the journal (if any)"""
+        if self.journal is not None and os.path.isfile(filepath):
+            self.journal.record(kind, filepath)
+
+    def is_computed(self, run, term, member):
+        """Check if files of a member are already in _computed_ for all domains"""
+        if self.stream_final:
+            return False
+        return all(file_is_done(self.journal, 'computed', self.get_path_file_in_computed(run, term, member, domain))
+                   for domain in self.domain)
+
+    def download_native_files_of_members(self, run, term, members=None):
+        """
+        Download simultaneously native files of several members, instead of one member after the other.
+
+        :param run: Run time.
+        :param term: Forecast lead time.
+        :param members: Members to download (default: members not already computed).
+        """
+        if not self.autofetch_native or len(self.members) < 2:
+            return
+        if members is None:
+            members = [member for member in self.members if not self.is_computed(run, term, member)]
+        readers = [cache_manager.extractor for (model_name, member), cache_manager in self.cache_managers.items()
+                   if member in members]
+        download_native_files(readers, run, term, self.member_workers)
 
-    def compute(self, run, term):
+    def compute_member(self, run, term, member):
+        """
+        Compute variables asked by the user for a member, for all domains.
+
+        :param run: Run time.
+        :param term: Forecast lead time (None for analysis).
+        :param member: Member number.
+        :return: dict {domain: path of the file in _computed_}, or {domain: computed values} if stream_final=True
+        """
+        for (model_name, member_of_manager), cache_manager in self.cache_managers.items():
+            if member_of_manager == member:
+                cache_manager.start_time_step(run, term)
+
+        def compute_domain(domain):
+            # Look at files already computed
+            path_file_in_computed = self.get_path_file_in_computed(
+                run, term, member, domain)
+            file_is_already_computed = not self.stream_final and file_is_done(
+                self.journal, 'computed', path_file_in_computed)
+
+            member_str = f", member {member}" if member else ""
+            computer_str = f"[COMPUTER] {run}, term {term}, domain {domain}{member_str}"
+            if file_is_already_computed:
+                logger.debug(f"{computer_str} already computed")
+                return path_file_in_computed
+
+            logger.debug(f"{computer_str} NOT computed")
+            # Store computed values before saving to netcdf
+            variables_storage = defaultdict(lambda: [])
+
+            # Native arrays are read once for all computed variables
+            memo = ReadCacheMemo()
+
+            # Iterate on variables asked by the user (i.e. computed var)
+            for computed_var in self.computed_vars:
+                computed_values = self.compute_variables_in_cache(
+                    computed_var, member, run, term, domain, memo=memo)
+                variables_storage[computed_var.name] = computed_values
+                logger.debug(f"[COMPUTER] "
+                             f"{computed_var.name}, "
+                             f"{run}, "
+                             f"term {term}, "
+                             f"domain {domain}{member_str} computed")
+            logger.debug(f"[COMPUTER] Native arrays read: {memo.misses}, reused: {memo.hits}")
+
+            if self.stream_final:
+                # Computed values are appended to the final file by the caller
+                result = dict(variables_storage)
+            else:
+                # Create netcdf file of computed values
+                variables_storage['time'] = validity_date(run, term)
+                self.save_computed_vars_to_netcdf(path_file_in_computed, variables_storage)
+                result = path_file_in_computed
+            logger.debug(f"[COMPUTER] {run}, term {term}, domain {domain}{member_str} computed and saved")
+            return result
+
+        return dict(zip(self.domain, self.map_domains(compute_domain, self.domain)))
+
+    def compute(self, run, term, time_tag=None):
         """
         Triggers computation of computed variables (i.e. variables asked by the user)
 
         :param run: Run time.
         :param term: Forecast lead time (None for analysis).
+        :param time_tag: Time tag of the batch (see Grouper.filetag), necessary when stream_final=True.
         """
-        for member in self.members:
-            for domain in self.domain:
+        # Download native files of all members at once
+        self.download_native_files_of_members(run, term)
 
-                # Look at files already computed
-                path_file_in_computed = self.get_path_file_in_computed(
-                    run, term, member, domain)
-                file_is_already_computed = os.path.isfile(
-                    path_file_in_computed)
-
-                member_str = f", member {member}" if member else ""
-                computer_str = f"[COMPUTER] {run}, term {term}, domain {domain}{member_str}"
-                if file_is_already_computed:
-                    logger.debug(f"{computer_str} already computed")
-                    self.computed_files[(member, domain)].append(
-                        path_file_in_computed)
-                else:
-                    logger.debug(f"{computer_str} NOT computed")
-                    # Store computed values before saving to netcdf
-                    variables_storage = defaultdict(lambda: [])
-
-                    # Iterate on variables asked by the user (i.e. computed var)
-                    for computed_var in self.computed_vars:
-                        computed_values = self.compute_variables_in_cache(computed_var, member, run, term, domain)
-                        variables_storage[computed_var.name] = computed_values
-                        logger.debug(f"[COMPUTER] "
-                                     f"{computed_var.name}, "
-                                     f"{run}, "
-                                     f"term {term}, "
-                                     f"domain {domain}{member_str} computed")
-                    variables_storage['time'] = validity_date(run, term)
-
-                    # Create netcdf file of computed values
-                    self.save_computed_vars_to_netcdf(path_file_in_computed, variables_storage)
+        if self.member_pool is not None:
+            results = self.member_pool.compute(run, term, self.members)
+        else:
+            results = {member: self.compute_member(run, term, member) for member in self.members}
 
+        for member in self.members:
+            for domain, result in results[member].items():
+                if self.stream_final:
+                    # Append computed values to the final file
+                    self.get_final_writer(time_tag, member, domain).append(validity_date(run, term), result)
+                else:
                     # Remember that current file is computed
-                    self.computed_files[(member, domain)].append(path_file_in_computed)
-                    logger.debug(f"[COMPUTER] {run}, term {term}, domain {domain}{member_str} computed and saved")
-
-            self.delete_native_files()
+                    self.computed_files[(member, domain)].append(result)
+                    if self.member_pool is not None and not file_is_done(self.journal, 'computed', result):
+                        # Member processes don't write in the journal
+                        self.record('computed', result)
+
+        self.delete_native_files(run, term)
+
+    def close(self):
+        """Stop processes computing members"""
+        if self.member_pool is not None:
+            self.member_pool.shutdown()
+            self.member_pool = None
@@ -0,0 +1,147 @@
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def file_is_done(journal, kind, filepath):
+    """
+    Check if a file is complete: in the journal if given, on the file system otherwise.
+
+    :param journal: WorkJournal or None
+    :param kind: 'native', 'cache', 'computed' or 'final'
+    :param filepath: Path to the file
+    """
+    if journal is not None:
+        return journal.contains(kind, filepath)
+    return os.path.isfile(filepath)
+
+
+class WorkJournal:
+    """
+    Append-only journal of the files completed during an extraction (native, cache, computed and final files).
+
+    Each completed file is recorded with its size and modification time, and each deleted file is recorded too.
+    When an extraction is relaunched, the journal is read once into an in-memory index: checking that a file
+    is already done does not access the file system (which is slow on NFS work folders for long extractions).
+
+    A file is recorded once it is completely written, so that a file interrupted by an error is never considered
+    done. When the journal is read, files deleted or modified since they were recorded (e.g. by hand) are
+    forgotten, so that they are extracted again.
+
+    :param filepath: Path to the journal (e.g. work_folder/journal.jsonl)
+    :param folders: dict {kind: folder}. If the journal doesn't exist yet, files already in these folders
+    (e.g. written by an extraction without journal) are recorded.
+    """
+
+    def __init__(self, filepath, folders=None):
+        self.filepath = filepath
+        self.root = os.path.dirname(os.path.abspath(filepath))
+        self.lock = threading.Lock()
+        self.index = {}
+        if os.path.isfile(self.filepath):
+            self.load()
+        elif folders:
+            self.scan(folders)
+
+    def get_key(self, kind, filepath):
+        return kind, os.path.relpath(os.path.abspath(filepath), self.root)
+
+    def get_filepath(self, path):
+        """Path of a file recorded in the journal"""
+        return os.path.join(self.root, path)
+
+    def load(self):
+        """Replay the journal into the in-memory index, then check that files done are unchanged"""
+        with open(self.filepath, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of a journal interrupted while writing
+                    continue
+                self.apply(entry)
+        changed = [(kind, path) for (kind, path), done in self.index.items()
+                   if not self.is_unchanged(self.get_filepath(path), done)]
+        for kind, path in changed:
+            self.forget(kind, self.get_filepath(path))
+        logger.info(f"[JOURNAL] {len(self.index)} files done read in {self.filepath}, "
+                    f"{len(changed)} files missing or modified since")
+
+    @staticmethod
+    def is_unchanged(filepath, done):
+        """Check that a file still exists, with the size and modification time recorded"""
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        return stat.st_size == done['size'] and stat.st_mtime == done['mtime']
+
+    def apply(self, entry):
+        """Update the index with an entry of the journal"""
+        kind, path = entry['kind'], entry['path']
+        if entry['done']:
+            self.index[(kind, path)] = dict(size=entry['size'], mtime=entry['mtime'])
+        elif path is None:
+            # All files of a kind are deleted (e.g. files in cache at the end of a batch)
+            for key in [key for key in self.index if key[0] == kind]:
+                del self.index[key]
+        else:
+            self.index.pop((kind, path), None)
+
+    def append(self, entry):
+        """Write an entry at the end of the journal and apply it"""
+        with self.lock:
+            with open(self.filepath, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+            self.apply(entry)
+
+    def scan(self, folders):
+        """Record files already in folders, e.g. when a journal is used in an existing work folder"""
+        for kind, folder in folders.items():
+            if not os.path.isdir(folder):
+                continue
+            for dir_entry in os.scandir(folder):
+                if dir_entry.is_file() and not dir_entry.name.endswith(('.lock', '.part', '.tmp')):
+                    _, path = self.get_key(kind, dir_entry.path)
+                    stat = dir_entry.stat()
+                    self.append(dict(kind=kind, path=path, done=True, size=stat.st_size, mtime=stat.st_mtime))
+
+    def contains(self, kind, filepath):
+        """Check if a file is done, without accessing the file system"""
+        return self.get_key(kind, filepath) in self.index
+
+    def get(self, kind, filepath):
+        """Return size and modification time of a file done, or None"""
+        return self.index.get(self.get_key(kind, filepath))
+
+    def record(self, kind, filepath):
+        """
+        Record a file completely written.
+
+        :param kind: 'native', 'cache', 'computed' or 'final'
+        :param filepath: Path to the file
+        """
+        _, path = self.get_key(kind, filepath)
+        stat = os.stat(filepath)
+        self.append(dict(kind=kind, path=path, done=True, size=stat.st_size, mtime=stat.st_mtime))
+
+    def forget(self, kind, filepath=None):
+        """
+        Record that a file is deleted.
+
+        :param kind: 'native', 'cache', 'computed' or 'final'
+        :param filepath: Path to the file. If None, all files of this kind are deleted.
+        """
+        path = self.get_key(kind, filepath)[1] if filepath is not None else None
+        self.append(dict(kind=kind, path=path, done=False, size=None, mtime=None))
+
+    def delete(self):
+        """Delete the journal, e.g. once the extraction is finished"""
+        with self.lock:
+            if os.path.isfile(self.filepath):
+                os.remove(self.filepath)
+            self.index = {}
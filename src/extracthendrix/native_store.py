@@ -0,0 +1,167 @@
+import os
+import fcntl
+import shutil
+import logging
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# Files and folders shared with other users of the same group
+SHARED_FILE_MODE = 0o664
+SHARED_FOLDER_MODE = 0o2775
+
+
+def set_mode(path, mode):
+    """Change permissions of a file created by the current user (best effort, the umask applies otherwise)"""
+    try:
+        os.chmod(path, mode)
+    except OSError as e:
+        logger.warning(f"[NATIVE STORE] Can not change permissions of {path}: {e}")
+
+
+def open_lock_file(path):
+    """
+    Open a lock file and return its file descriptor.
+
+    Lock files are created group-writable, so that other users of a shared folder can lock them too.
+    A lock file of another user that is not writable is opened read-only.
+
+    :param path: Path to the lock file, created if necessary.
+    """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, SHARED_FILE_MODE)
+        set_mode(path, SHARED_FILE_MODE)
+        return fd
+    except FileExistsError:
+        pass
+    try:
+        return os.open(path, os.O_RDWR)
+    except PermissionError:
+        return os.open(path, os.O_RDONLY)
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """
+    Lock a file (shared between processes, e.g. several extractions).
+
+    If the file can't be locked (e.g. exclusive lock on a read-only file on NFS), a warning is logged
+    and the caller goes on without lock: files are always published with atomic renames.
+
+    :param path: Path to the lock file, created if necessary.
+    :param exclusive: Exclusive lock if True, shared lock otherwise.
+    """
+    fd = open_lock_file(path)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            locked = True
+        except OSError as e:
+            logger.warning(f"[NATIVE STORE] Can not lock {path}, continuing without lock: {e}")
+            locked = False
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class SharedNativeStore:
+    """
+    A folder storing native files (.fa, .grib) shared by several extractions (e.g. by several users).
+
+    Files are named by the resource they contain (see AromeHendrixReader.get_file_hash), so that an extraction
+    finds files downloaded by another one instead of downloading them again on Hendrix.
+    Files are published with atomic renames, and least recently used files are deleted when the size of
+    the store exceeds max_bytes. A lock file protects the store against concurrent processes.
+
+    The store is created group-writable. Files of other users that can't be modified (e.g. in a folder with
+    the sticky bit) are still read: marking them as recently used or deleting them is best effort.
+
+    :param path: Path to the folder of the store.
+    :param max_bytes: Maximum size of the store in bytes. None means no limit.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+            set_mode(self.path, SHARED_FOLDER_MODE)
+        self.lock_path = os.path.join(self.path, '.lock')
+
+    def get_path(self, filename):
+        """Return path of a file in the store"""
+        return os.path.join(self.path, filename)
+
+    def fetch(self, filename, destination):
+        """
+        Put a file of the store at destination (hard link if possible, copy otherwise).
+
+        :param filename: Name of the file in the store.
+        :param destination: Path where the file is expected (e.g. in _native_).
+        :return: True if the file was in the store
+        """
+        path_in_store = self.get_path(filename)
+        with file_lock(self.lock_path, exclusive=False):
+            if not os.path.isfile(path_in_store):
+                return False
+            tmp_destination = f"{destination}.{uuid.uuid4().hex[:5]}.tmp"
+            try:
+                os.link(path_in_store, tmp_destination)
+            except OSError:
+                shutil.copyfile(path_in_store, tmp_destination)
+            os.replace(tmp_destination, destination)
+            # Mark the file as recently used
+            try:
+                os.utime(path_in_store)
+            except OSError as e:
+                logger.warning(f"[NATIVE STORE] Can not mark {filename} as recently used: {e}")
+        logger.info(f"[NATIVE STORE] {filename} found in shared store {self.path}")
+        return True
+
+    def publish(self, filepath):
+        """
+        Add a downloaded file to the store, then delete least recently used files if the store is too large.
+
+        :param filepath: Path to the downloaded file (its name is kept in the store).
+        """
+        filename = os.path.basename(filepath)
+        path_in_store = self.get_path(filename)
+        if not os.path.isfile(filepath) or os.path.isfile(path_in_store):
+            return
+        tmp_path = f"{path_in_store}.{uuid.uuid4().hex[:5]}.tmp"
+        try:
+            os.link(filepath, tmp_path)
+        except OSError:
+            shutil.copyfile(filepath, tmp_path)
+        # Other users can mark the file as recently used
+        set_mode(tmp_path, SHARED_FILE_MODE)
+        with file_lock(self.lock_path):
+            os.replace(tmp_path, path_in_store)
+            self.evict()
+        logger.debug(f"[NATIVE STORE] {filename} published in shared store {self.path}")
+
+    def evict(self):
+        """Delete least recently used files until the size of the store is below max_bytes (lock must be held)"""
+        if self.max_bytes is None:
+            return
+        files = [entry for entry in os.scandir(self.path)
+                 if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.tmp')]
+        total_bytes = sum(entry.stat().st_size for entry in files)
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            if total_bytes <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.warning(f"[NATIVE STORE] Can not delete {entry.name} from shared store {self.path}: {e}")
+                continue
+            total_bytes -= size
+            logger.debug(f"[NATIVE STORE] {entry.name} deleted from shared store {self.path}")
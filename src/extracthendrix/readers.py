@@ -3,9 +3,16 @@ from datetime import timedelta, time, datetime, date
 import itertools
 import os
 import configparser
-import pkg_resources
+import functools
+from types import MappingProxyType
+import io
+import json
+import threading
+import time as timeutils
+from contextlib import contextmanager
 from copy import deepcopy
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 
 import ftplib
 from ftplib import FTP
@@ -17,18 +24,274 @@ import xarray as xr
 import usevortex
 
 # from extracthendrix.core import get_all_resource_descriptions, CanNotReadEpygramField, CanNotAccessVortexResource
+from extracthendrix.native_store import file_lock
+from extracthendrix.journal import file_is_done
 from extracthendrix.exceptions import RunDoesntExistException, MoreThanOneRunMatchException, GeometryIsMissingException
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-def return_path_if_exists_on_hendrix(ftp, path_resource):
+def get_hendrix_credentials():
+    """Return credentials (login, account, password) for Hendrix from .netrc"""
+    credentials = netrc().authenticators('hendrix')
+    if credentials is None:
+        credentials = netrc().authenticators('hendrix.meteo.fr')
+    return credentials
+
+
+class FTPSessionPool:
+    """
+    Keeps FTP sessions opened on Hendrix to reuse them instead of login again for each request.
+
+    Sessions are given in the folder where they were at login (i.e. the home folder on Hendrix), whatever
+    the folder where they were left by their previous user, so that relative paths are always valid.
+
+    :param host: FTP server
+    :param port: FTP port
+    :param credentials: (login, account, password). If None, credentials are read in .netrc
+    :param size: Maximum number of simultaneous sessions
+    """
+
+    def __init__(self, host='hendrix.meteo.fr', port=21, credentials=None, size=1):
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+        self.size = size
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle_sessions = []
+        self.all_sessions = []
+        self.login_folders = {}
+
+    def connect(self):
+        """Open and login a new FTP session"""
+        if self.credentials is None:
+            self.credentials = get_hendrix_credentials()
+        ftp = FTP()
+        ftp.connect(self.host, self.port)
+        ftp.login(self.credentials[0], self.credentials[2])
+        login_folder = ftp.pwd()
+        logger.debug(f"[FTP] New session on {self.host}")
+        with self.lock:
+            self.all_sessions.append(ftp)
+            self.login_folders[ftp] = login_folder
+        return ftp
+
+    def go_to_login_folder(self, ftp):
+        """
+        Go back to the folder of the session at login (e.g. after DirectoryListingCache.get_listing).
+
+        :return: False if the session is not connected anymore
+        """
+        try:
+            ftp.cwd(self.login_folders[ftp])
+            return True
+        except (ftplib.all_errors):
+            return False
+
+    def forget(self, ftp):
+        """Close a session and stop using it"""
+        with self.lock:
+            if ftp in self.all_sessions:
+                self.all_sessions.remove(ftp)
+            self.login_folders.pop(ftp, None)
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager giving an opened FTP session.
+
+        e.g.
+            with pool.session() as ftp:
+                ftp.nlst()
+        """
+        with self.semaphore:
+            ftp = None
+            with self.lock:
+                if self.idle_sessions:
+                    ftp = self.idle_sessions.pop()
+            if ftp is not None and not self.go_to_login_folder(ftp):
+                self.forget(ftp)
+                ftp = None
+            if ftp is None:
+                ftp = self.connect()
+            try:
+                yield ftp
+            except ftplib.all_errors:
+                # The session might be broken, don't reuse it
+                self.forget(ftp)
+                raise
+            else:
+                with self.lock:
+                    self.idle_sessions.append(ftp)
+
+    def close(self):
+        """Close all sessions"""
+        with self.lock:
+            sessions, self.all_sessions, self.idle_sessions = self.all_sessions, [], []
+            self.login_folders = {}
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+class DirectoryListingCache:
+    """
+    Remembers the content of folders on Hendrix, so that each folder is listed only once.
+
+    Listings can be saved in a json file and reused by later requests while they are younger than ttl.
+
+    :param filepath: Path to the json file. If None, listings are only kept in memory.
+    :param ttl: Time to live of listings in seconds. None means listings never expire.
+    """
+
+    def __init__(self, filepath=None, ttl=None):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.listings = {}
+        self.load()
+
+    def load(self):
+        """Read listings saved by previous requests"""
+        if self.filepath and os.path.isfile(self.filepath):
+            with open(self.filepath, 'r') as f:
+                self.listings = json.load(f)
+
+    def save(self):
+        """Write listings to the json file"""
+        if self.filepath and os.path.isdir(os.path.dirname(self.filepath)):
+            with self.lock:
+                listings = dict(self.listings)
+            tmp_filepath = f"{self.filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, 'w') as f:
+                json.dump(listings, f)
+            os.replace(tmp_filepath, self.filepath)
+
+    def is_valid(self, listing):
+        """Check that a listing is not expired"""
+        return self.ttl is None or timeutils.time() - listing['time'] < self.ttl
+
+    def get_listing(self, ftp, path_folder):
+        """
+        Return names of the files in a folder on Hendrix.
+
+        A folder that doesn't exist has an empty listing.
+
+        :param ftp: FTP session
+        :param path_folder: Path of the folder on Hendrix
+        :return: list of file names
+        """
+        with self.lock:
+            listing = self.listings.get(path_folder)
+        if listing is not None and self.is_valid(listing):
+            return listing['files']
+        try:
+            ftp.cwd(path_folder)
+            files = ftp.nlst()
+        except ftplib.error_perm:
+            files = []
+        with self.lock:
+            self.listings[path_folder] = dict(files=files, time=timeutils.time())
+        return files
+
+
+class VortexLocateCache:
+    """
+    Remembers locations of resources on Hendrix given by vortex (getmode='locate').
+
+    Locations are saved in a json file, keyed by the resource description, so that a prestaging request
+    on an overlapping period doesn't resolve them again.
+
+    :param filepath: Path to the json file. If None, locations are only kept in memory.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.locations = {}
+        self.load()
+
+    def load(self):
+        """Read locations saved by previous requests"""
+        if self.filepath and os.path.isfile(self.filepath):
+            with open(self.filepath, 'r') as f:
+                self.locations = json.load(f)
+
+    def save(self):
+        """Write locations to the json file"""
+        if self.filepath and os.path.isdir(os.path.dirname(self.filepath)):
+            with self.lock:
+                locations = dict(self.locations)
+            tmp_filepath = f"{self.filepath}.{os.getpid()}.tmp"
+            with open(tmp_filepath, 'w') as f:
+                json.dump(locations, f)
+            os.replace(tmp_filepath, self.filepath)
+
+    @staticmethod
+    def get_key(resource_description):
+        """Key of a resource description (dates are converted to str)"""
+        return json.dumps(resource_description, sort_keys=True, default=str)
+
+    def locate(self, resource_description):
+        """
+        Return the locations of a resource, asking vortex only if it is not already known.
+
+        :param resource_description: Vortex resource description
+        :return: list of locations (e.g. ['hendrix.meteo.fr:/path/to/file'])
+        """
+        key = self.get_key(resource_description)
+        with self.lock:
+            if key in self.locations:
+                return self.locations[key]
+        locations = [str(location) for location in
+                     usevortex.get_resources(getmode='locate', **resource_description)]
+        with self.lock:
+            self.locations[key] = locations
+        return locations
+
+
+def locate_resources(resource_descriptions, locate_cache=None, workers=4):
+    """
+    Locate resources on Hendrix with vortex, in a pool of threads.
+
+    :param resource_descriptions: List of vortex resource descriptions
+    :param locate_cache: VortexLocateCache, optional
+    :param workers: Maximum number of simultaneous requests
+    :return: List of locations, in the same order as resource_descriptions
+    """
+    if locate_cache is None:
+        locate_cache = VortexLocateCache()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(locate_cache.locate, resource_descriptions))
+
+
+def return_path_if_exists_on_hendrix(ftp, path_resource, listing_cache=None):
+    """
+    Return the path of a file on Hendrix.
+
+    Raises StopIteration if the file doesn't exist.
+
+    :param ftp: FTP session
+    :param path_resource: Path of the file on Hendrix as given by vortex (can be only a part of the file name)
+    :param listing_cache: DirectoryListingCache, optional
+    :return: path
+    """
     file_name = path_resource.split('/')[-1]
     path_folder = os.path.dirname(path_resource)
     # Check that the file exist at the specified path
-    ftp.cwd(path_folder)
-    listing_folder = ftp.nlst()
+    if listing_cache is not None:
+        listing_folder = listing_cache.get_listing(ftp, path_folder)
+    else:
+        ftp.cwd(path_folder)
+        listing_folder = ftp.nlst()
     full_file_name = next(x for x in listing_folder if file_name in x)
     return os.path.join(path_folder, full_file_name)
 
@@ -37,13 +300,361 @@ class NativeFileUnfetchedException(Exception):
     pass
 
 
+MODELS_INI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'models.ini')
+
+
+@functools.lru_cache(maxsize=None)
+def get_models_registry():
+    """
+    Parse config/models.ini once and return an immutable registry of model descriptions.
+
+    :return: read-only mapping model name -> read-only mapping key -> tuple of possible values
+    """
+    config = configparser.ConfigParser()
+    with open(MODELS_INI_PATH, 'r') as f:
+        config.read_file(f)
+    return MappingProxyType({
+        model_name: MappingProxyType({key: tuple(value.split(',')) for key, value in config[model_name].items()})
+        for model_name in config.sections()
+    })
+
+
 def model_ini_to_dict(model_name):
     """Converts config/models.ini into a dictionary"""
-    config = configparser.ConfigParser()
-    models_path = pkg_resources.resource_filename('extracthendrix.config', 'models.ini')
-    config.read(models_path)
-    dict_model = dict(config[model_name])
-    return dict_model
+    return {key: ','.join(values) for key, values in get_models_registry()[model_name].items()}
+
+
+def get_model_members(model_name):
+    """
+    Members of an ensemble model listed in config/models.ini (e.g. PEAROME_SURFACE).
+
+    :param model_name: Model name.
+    :return: tuple of members, empty if the model doesn't list members
+    """
+    return tuple(int(member) for member in get_models_registry()[model_name].get('member', ()))
+
+
+def get_default_members(model_names):
+    """
+    All members of the models extracted, used when the user asks for members='all'.
+
+    :param model_names: Names of the models extracted.
+    :return: sorted list of members listed in config/models.ini for these models, or [None]
+    """
+    members = {member for model_name in model_names for member in get_model_members(model_name)}
+    return sorted(members) if members else [None]
+
+
+def get_members(members, model_names):
+    """
+    Members to extract.
+
+    :param members: List of members given by the user, or 'all' for all members listed in config/models.ini.
+    :param model_names: Names of the models extracted.
+    :return: list of members
+    """
+    if members == 'all':
+        members = get_default_members(model_names)
+        logger.info(f"[EXTRACTOR] Members listed in models.ini are extracted: {members}")
+    return members
+
+
+@functools.lru_cache(maxsize=None)
+def expand_resource_descriptions(model_name, member=None):
+    """
+    Cartesian product of all possible values of a model description (computed once for each model and member).
+
+    If no member is given, members listed in config/models.ini are alternatives of the resource.
+    Use members='all' to extract each member separately (see get_members and download_native_files).
+
+    :param model_name: Model name.
+    :param member: Member number
+    :return: tuple of read-only resource descriptions
+    """
+    dict_model = dict(get_models_registry()[model_name])
+
+    if member:
+        dict_model['member'] = (member,)
+
+    keys, values = zip(*dict_model.items())
+    return tuple(MappingProxyType(dict(zip(keys, v))) for v in itertools.product(*values))
+
+
+def download_native_files(readers, date, term, workers=4):
+    """
+    Download native files of several readers (e.g. one for each member) simultaneously.
+
+    :param readers: List of AromeHendrixReader
+    :param date: Run time.
+    :param term: Forecast lead time.
+    :param workers: Maximum number of simultaneous downloads.
+    :return: list of file paths
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reader.get_native_file, date, term) for reader in readers]
+    # Raise the first error, once all downloads are finished
+    return [future.result() for future in futures]
+
+
+def download_from_hendrix(ftp_pool, path_on_hendrix, filepath):
+    """
+    Download a file from Hendrix with FTP (without vortex), unless it is already downloaded.
+
+    The file is copied as it is on Hendrix. As in AromeHendrixReader.get_native_file, a lock file
+    prevents two requesters from downloading the same file, and the file is renamed once complete.
+
+    :param ftp_pool: FTPSessionPool
+    :param path_on_hendrix: Path of the file on Hendrix
+    :param filepath: Path where the file is written (e.g. in _native_)
+    :return: filepath
+    """
+    with file_lock(f"{filepath}.lock"):
+        if os.path.isfile(filepath):
+            return filepath
+        with ftp_pool.session() as ftp, open(f"{filepath}.part", 'wb') as f:
+            ftp.retrbinary(f"RETR {path_on_hendrix}", f.write)
+        os.replace(f"{filepath}.part", filepath)
+    logger.debug(f"[FTP] {path_on_hendrix} downloaded to {filepath}")
+    return filepath
+
+
+def ingest_native_files(readers, dateandtermiterator, ftp_pool, listing_cache=None, locate_cache=None,
+                        locate_workers=4):
+    """
+    Download all native files of a period at once, e.g. once they are prestaged on Hendrix.
+
+    Files are located on Hendrix as for prestaging, then transferred by FTP in a pool of threads,
+    each transfer reusing a session of ftp_pool. Files are written in _native_ with the name expected
+    by AromeHendrixReader.get_native_file, that won't download them again.
+
+    :param readers: List of AromeHendrixReader (one for each model and member)
+    :param dateandtermiterator: Iterable of (date, term)
+    :param ftp_pool: FTPSessionPool. Its size is the number of simultaneous transfers.
+    :param listing_cache: DirectoryListingCache, optional
+    :param locate_cache: VortexLocateCache, optional
+    :param locate_workers: Number of simultaneous vortex 'locate' requests
+    :return: list of paths of the files in _native_, list of resources not found
+    """
+    files_by_step, notfound = locate_native_files_by_step(
+        readers, dateandtermiterator, ftp_pool, listing_cache, locate_cache, locate_workers)
+    transfers = {filepath: path_on_hendrix
+                 for step_transfers in files_by_step.values()
+                 for filepath, path_on_hendrix in step_transfers.items()}
+    logger.info(f"[FTP] Ingest {len(transfers)} files from Hendrix")
+    with ThreadPoolExecutor(max_workers=ftp_pool.size) as executor:
+        futures = [executor.submit(download_from_hendrix, ftp_pool, path_on_hendrix, filepath)
+                   for filepath, path_on_hendrix in transfers.items()]
+    return [future.result() for future in futures], notfound
+
+
+def locate_native_files_by_step(readers, dateandtermiterator, ftp_pool, listing_cache=None, locate_cache=None,
+                                locate_workers=4):
+    """
+    Find paths on Hendrix of the native files of each time step.
+
+    :param readers: List of AromeHendrixReader (one for each model and member)
+    :param dateandtermiterator: Iterable of (date, term)
+    :param ftp_pool: FTPSessionPool
+    :param listing_cache: DirectoryListingCache, optional
+    :param locate_cache: VortexLocateCache, optional
+    :param locate_workers: Number of simultaneous vortex 'locate' requests
+    :return: dict {(date, term): {path in _native_: path on Hendrix}} in time order, list of resources not found
+    """
+    dateandtermiterator = list(dateandtermiterator)
+    files_by_step = {date_and_term: {} for date_and_term in dateandtermiterator}
+    notfound = []
+    for reader in readers:
+        found, reader_notfound = reader.locate_native_files(
+            dateandtermiterator, ftp_pool, listing_cache, locate_cache, locate_workers)
+        notfound += reader_notfound
+        for date_, term, path_on_hendrix in found:
+            # If several variants of a resource exist, the first one is kept
+            files_by_step[(date_, term)].setdefault(reader.get_path_file_in_native(date_, term), path_on_hendrix)
+    return files_by_step, notfound
+
+
+def prestaging_request_content(listfiles, email_address):
+    """Content of a prestaging request: email address of the user, then one file on Hendrix per line"""
+    return "".join([f"#MAIL={email_address}\n"] + [f"{path}\n" for path in listfiles])
+
+
+class PrestagingPipeline:
+    """
+    Submits prestaging requests on Hendrix and downloads native files as soon as they are prestaged.
+
+    Time steps are split in chunks of at most chunk_size files, each chunk being a separate request
+    dropped in DemandeMig/ChargeEnEspaceRapide (uploaded as .txt, then renamed in .MIG once complete).
+    Requests are polled in time order. Once Hendrix has consumed a request, the files of its chunk are polled too
+    (their size is asked by FTP), and files are downloaded only when they are all available on Hendrix,
+    so that the extraction starts after the first chunk. Files still not available after max_file_polls polls
+    are left to vortex, as well as files of requests still not consumed after max_request_polls polls.
+
+    e.g.
+        pipeline = PrestagingPipeline(ftp_pool, files_by_step, "prestaging_user", "user@meteo.fr")
+        pipeline.start()
+        pipeline.wait(date, term)  # Returns once native files of (date, term) are in _native_
+    """
+    request_folder = 'DemandeMig/ChargeEnEspaceRapide'
+
+    def __init__(self, ftp_pool, files_by_step, request_name, email_address, chunk_size=500, poll_interval=600,
+                 max_file_polls=6, max_request_polls=144):
+        """
+        :param ftp_pool: FTPSessionPool. Its size is the number of simultaneous transfers.
+        :param files_by_step: dict {(date, term): {path in _native_: path on Hendrix}} (see locate_native_files_by_step)
+        :param request_name: Name of the requests on Hendrix (a suffix is added for each chunk)
+        :param email_address: Email address written in the requests
+        :param chunk_size: Maximum number of files in a request
+        :param poll_interval: Time in seconds between two checks of the requests on Hendrix
+        :param max_file_polls: Number of checks of the files of a consumed request before giving up on missing files
+        :param max_request_polls: Number of checks of a request before giving up on it (e.g. lost request)
+        """
+        self.ftp_pool = ftp_pool
+        self.request_name = request_name
+        self.email_address = email_address
+        self.poll_interval = poll_interval
+        self.max_file_polls = max_file_polls
+        self.max_request_polls = max_request_polls
+        self.chunks = self.split(files_by_step, chunk_size)
+        self.chunk_of_step = {date_and_term: index
+                              for index, chunk in enumerate(self.chunks)
+                              for date_and_term in chunk}
+        self.ready = [threading.Event() for _ in self.chunks]
+        self.errors = {}
+        self.thread = None
+
+    @staticmethod
+    def split(files_by_step, chunk_size):
+        """
+        Split time steps in chunks of at most chunk_size files, in time order.
+
+        Files already downloaded are not requested. A time step is never split between two chunks.
+
+        :return: list of dict {(date, term): {path in _native_: path on Hendrix}}
+        """
+        chunks = [{}]
+        size = 0
+        for date_and_term, transfers in files_by_step.items():
+            transfers = {filepath: path_on_hendrix for filepath, path_on_hendrix in transfers.items()
+                         if not os.path.isfile(filepath)}
+            if size and size + len(transfers) > chunk_size:
+                chunks.append({})
+                size = 0
+            chunks[-1][date_and_term] = transfers
+            size += len(transfers)
+        return chunks
+
+    def get_request_name(self, index):
+        return f"{self.request_name}_part{index}"
+
+    def submit(self):
+        """Upload a request for each chunk"""
+        for index, chunk in enumerate(self.chunks):
+            listfiles = [path_on_hendrix for transfers in chunk.values() for path_on_hendrix in transfers.values()]
+            if listfiles:
+                self.upload_request(self.get_request_name(index), prestaging_request_content(listfiles, self.email_address))
+
+    def upload_request(self, name, content):
+        """Drop a request on Hendrix, and rename it in .MIG once fully uploaded"""
+        path = f"{self.request_folder}/{name}"
+        with self.ftp_pool.session() as ftp:
+            ftp.storbinary(f"STOR {path}.txt", io.BytesIO(content.encode()))
+            ftp.rename(f"{path}.txt", f"{path}.MIG")
+        logger.info(f"[PRESTAGING] Request {name}.MIG submitted on Hendrix")
+
+    def is_request_done(self, name):
+        """A request is done once Hendrix has removed it from the folder of requests"""
+        with self.ftp_pool.session() as ftp:
+            requests = [os.path.basename(request) for request in ftp.nlst(self.request_folder)]
+        return f"{name}.MIG" not in requests
+
+    def wait_for_request(self, name):
+        """
+        Poll a request until Hendrix has consumed it.
+
+        :param name: Name of the request
+        :return: False if the request is still not consumed after max_request_polls polls
+        """
+        for poll in range(self.max_request_polls):
+            if self.is_request_done(name):
+                return True
+            logger.debug(f"[PRESTAGING] Waiting for {name}.MIG")
+            if poll + 1 < self.max_request_polls:
+                sleep(self.poll_interval)
+        return False
+
+    def get_file_size(self, path_on_hendrix):
+        """Size of a file on Hendrix, None if the file is not available"""
+        with self.ftp_pool.session() as ftp:
+            try:
+                ftp.voidcmd('TYPE I')
+                return ftp.size(path_on_hendrix)
+            except ftplib.error_perm:
+                return None
+
+    def wait_for_files(self, name, transfers):
+        """
+        Poll files of a consumed request until they are all available on Hendrix.
+
+        :param name: Name of the request
+        :param transfers: dict {path in _native_: path on Hendrix}
+        :return: transfers of available files, missing files being left to vortex
+        """
+        missing = dict(transfers)
+        available = {}
+        for poll in range(self.max_file_polls):
+            with ThreadPoolExecutor(max_workers=self.ftp_pool.size) as executor:
+                sizes = dict(zip(missing, executor.map(self.get_file_size, missing.values())))
+            for filepath, size in sizes.items():
+                if size:
+                    available[filepath] = missing.pop(filepath)
+            if not missing:
+                break
+            logger.debug(f"[PRESTAGING] Waiting for {len(missing)} files of {name}")
+            if poll + 1 < self.max_file_polls:
+                sleep(self.poll_interval)
+        if missing:
+            logger.warning(f"[PRESTAGING] {len(missing)} files of {name} are not available on Hendrix, "
+                           f"they will be downloaded with vortex")
+        return available
+
+    def run(self):
+        """Wait for each chunk to be prestaged, in time order, and download its files"""
+        for index, chunk in enumerate(self.chunks):
+            transfers = {filepath: path_on_hendrix for step_transfers in chunk.values()
+                         for filepath, path_on_hendrix in step_transfers.items()}
+            try:
+                if transfers:
+                    if not self.wait_for_request(self.get_request_name(index)):
+                        raise TimeoutError(f"{self.get_request_name(index)}.MIG not consumed by Hendrix after "
+                                           f"{self.max_request_polls} polls")
+                    transfers = self.wait_for_files(self.get_request_name(index), transfers)
+                    with ThreadPoolExecutor(max_workers=self.ftp_pool.size) as executor:
+                        futures = [executor.submit(download_from_hendrix, self.ftp_pool, path_on_hendrix, filepath)
+                                   for filepath, path_on_hendrix in transfers.items()]
+                    for future in futures:
+                        future.result()
+                    logger.info(f"[PRESTAGING] {len(transfers)} files of {self.get_request_name(index)} downloaded")
+            except Exception as e:
+                # Files of the chunk will be downloaded with vortex by the extraction
+                logger.warning(f"[PRESTAGING] {self.get_request_name(index)} failed: {e}")
+                self.errors[index] = e
+            self.ready[index].set()
+
+    def start(self):
+        """Submit requests, then poll and download in a background thread"""
+        self.submit()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def wait(self, date, term):
+        """Block until native files of (date, term) are downloaded"""
+        index = self.chunk_of_step.get((date, term))
+        if index is not None:
+            self.ready[index].wait()
+
+    def close(self):
+        """Close FTP sessions"""
+        self.ftp_pool.close()
 
 
 #  old get_model_description
@@ -59,19 +670,7 @@ def get_all_resource_descriptions(model_name, member=None):
     :param member: Member number
     :return: List of model descriptions
     """
-
-    dict_model = model_ini_to_dict(model_name)
-
-    for key in dict_model.keys():
-        dict_model[key] = dict_model[key].split(',')
-
-    if member:
-        dict_model['member'] = [member]
-
-    keys, values = zip(*dict_model.items())
-    list_dict_models = [dict(zip(keys, v)) for v in itertools.product(*values)]
-
-    return list_dict_models
+    return [dict(resource_description) for resource_description in expand_resource_descriptions(model_name, member)]
 
 
 class HendrixFileReader:
@@ -305,27 +904,91 @@ class VortexWitchCraftReader(S2MTaskMixIn):
         tb[0].get()
 
 
+class ResourceVariantMemory:
+    """
+    Remembers which variant of a resource description (e.g. which namespace) worked for the last download.
+
+    Files of neighbouring dates are usually served by the same variant: trying it first avoids
+    a failed request on Hendrix for each file. The variant is saved in a json file in the work folder.
+
+    :param filepath: Path to the json file. If None, the variant is only kept in memory.
+    """
+    # Keys that change for each file and don't identify a variant (all members share the json file)
+    keys_of_file = ['date', 'term', 'local', 'member']
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.last_success = None
+        if self.filepath and os.path.isfile(self.filepath):
+            try:
+                with open(self.filepath, 'r') as f:
+                    self.last_success = json.load(f).get('last_success')
+            except ValueError:
+                logger.warning(f"[EXTRACTOR] Can not read {self.filepath}, variants are tried in order of models.ini")
+
+    def get_key(self, resource_description):
+        """Identifies the variant of a resource description"""
+        variant = {key: value for key, value in resource_description.items() if key not in self.keys_of_file}
+        return json.dumps(variant, sort_keys=True, default=str)
+
+    def sort(self, resource_descriptions):
+        """Put the variant that worked last first, keep the order of models.ini for others"""
+        return sorted(resource_descriptions, key=lambda rd: self.get_key(rd) != self.last_success)
+
+    def remember(self, resource_description):
+        """
+        Remember the variant that worked.
+
+        :param resource_description: resource description used for a successful download
+        """
+        key = self.get_key(resource_description)
+        with self.lock:
+            if key == self.last_success:
+                return
+            self.last_success = key
+            if self.filepath:
+                # Readers of other members write the same file simultaneously
+                tmp_filepath = f"{self.filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_filepath, 'w') as f:
+                    json.dump(dict(last_success=key), f)
+                os.replace(tmp_filepath, self.filepath)
+
+
 class AromeHendrixReader(HendrixFileReader):
     """This class helps to extract AROME and ARPEGE files on Hendrix"""
     def __init__(self,
                  folderLayout=None,
                  model=None,
                  member=None,
-                 getmode='get' #"get"
+                 getmode='get', #"get"
+                 shared_store=None,
+                 journal=None
                  ):
         """
         :param folderLayout: instance of the class FolderLayout. Gives information about the working directory.
         :param model: Model name
         :param member: Member number
         :param getmode: getmode (for testing purpose)
+        :param shared_store: SharedNativeStore where native files are looked for before downloading them (optional)
+        :param journal: WorkJournal recording downloaded files (optional, the file system is checked otherwise)
         """
         self.folderLayout = folderLayout
+        self.shared_store = shared_store
+        self.journal = journal
         self.getmode = getmode
         self.model_name = model
         self.member = member
         # List with all model descriptions possibles (including alternative parameters such as "namespace")
         self.list_resource_descriptions = get_all_resource_descriptions(model, member) # old list_model_descriptions
         self.fmt = self.list_resource_descriptions[0]['nativefmt']  # FA or GRIB
+        self.variant_memory = ResourceVariantMemory(self.get_path_variant_memory())
+
+    def get_path_variant_memory(self):
+        """Path of the file remembering which resource description worked last (one file per model)"""
+        if self.folderLayout is None:
+            return None
+        return os.path.join(self.folderLayout.work_folder, f"resource_variant_{self.model_name}.json")
 
     def get_file_hash(self, date, term):
         """
@@ -341,28 +1004,59 @@ class AromeHendrixReader(HendrixFileReader):
         hash_ = f"{self.model_name}_run_{date}{term}{memberstr}"
         return hash_
 
-    def get_file_list(self, dateandtermiterator):
-        ftp = FTP('hendrix.meteo.fr')
-        credentials = netrc().authenticators('hendrix')
-        if credentials is None:
-            credentials = netrc().authenticators('hendrix.meteo.fr')
-        ftp.login(credentials[0], credentials[2])
-        filelist = []
+    def get_file_list(self, dateandtermiterator, ftp_pool=None, listing_cache=None, locate_cache=None,
+                      locate_workers=4):
+        """
+        Return paths on Hendrix of native files (e.g. to write a prestaging request).
+
+        :param dateandtermiterator: Iterable of (date, term)
+        :param ftp_pool: FTPSessionPool. If None, a session is opened for this call.
+        :param listing_cache: DirectoryListingCache. If None, listings are only remembered during this call.
+        :param locate_cache: VortexLocateCache. If None, locations are only remembered during this call.
+        :param locate_workers: Number of simultaneous vortex 'locate' requests.
+        :return: list of paths found, list of resources not found
+        """
+        close_pool = ftp_pool is None
+        if ftp_pool is None:
+            ftp_pool = FTPSessionPool()
+        if listing_cache is None:
+            listing_cache = DirectoryListingCache()
+        try:
+            found, notfound = self.locate_native_files(
+                dateandtermiterator, ftp_pool, listing_cache, locate_cache, locate_workers)
+        finally:
+            if close_pool:
+                ftp_pool.close()
+        return [path_on_hendrix for _, _, path_on_hendrix in found], notfound
+
+    def locate_native_files(self, dateandtermiterator, ftp_pool, listing_cache=None, locate_cache=None,
+                            locate_workers=4):
+        """
+        Find paths on Hendrix of native files.
+
+        :param dateandtermiterator: Iterable of (date, term)
+        :param ftp_pool: FTPSessionPool
+        :param listing_cache: DirectoryListingCache, optional
+        :param locate_cache: VortexLocateCache, optional
+        :param locate_workers: Number of simultaneous vortex 'locate' requests.
+        :return: list of (date, term, path on Hendrix) found, list of resources not found
+        """
+        requests = [
+            (date_, term, resource_description)
+            for date_, term in dateandtermiterator
+            for resource_description in self._get_vortex_resource_description(date_, term)]
+        potential_locations = locate_resources(
+            [resource_description for _, _, resource_description in requests], locate_cache, locate_workers)
+        found = []
         notfound = []
-        for date_, term in dateandtermiterator:
-            resdesc = self._get_vortex_resource_description(date_, term)
-            potential_locations = [
-                usevortex.get_resources(
-                    getmode='locate', **resource_description
-                )
-                for resource_description in resdesc]
-            for resource in potential_locations:
+        with ftp_pool.session() as ftp:
+            for (date_, term, _), resource in zip(requests, potential_locations):
                 try:
-                    filelist.append(return_path_if_exists_on_hendrix(ftp, resource[0].split(':')[1]))
+                    found.append((date_, term, return_path_if_exists_on_hendrix(
+                        ftp, resource[0].split(':')[1], listing_cache)))
                 except (ftplib.error_perm, StopIteration):
                     notfound.append(resource[0])
-        ftp.close()
-        return filelist, notfound
+        return found, notfound
 
     def _get_vortex_resource_description(self, date, term):
         """
@@ -373,6 +1067,7 @@ class AromeHendrixReader(HendrixFileReader):
         :return: List of resource descriptions.
         """
         resource_descriptions = []
+        term_iteration = term
         list_resource_descriptions = deepcopy(self.list_resource_descriptions)
         for model_description in list_resource_descriptions:
 
@@ -389,6 +1084,11 @@ class AromeHendrixReader(HendrixFileReader):
 
         return resource_descriptions
 
+    def record_native_file(self, filepath):
+        """Record a downloaded file in the journal"""
+        if self.journal is not None and os.path.isfile(filepath):
+            self.journal.record('native', filepath)
+
     def get_native_file(self, date, term, autofetch=True):
         """
         Download files on Hendrix if necessary.
@@ -401,26 +1101,136 @@ class AromeHendrixReader(HendrixFileReader):
         filepath = self.get_path_file_in_native(date, term)
 
         # If file is downloaded, we skip
-        file_already_downloaded = os.path.isfile(filepath)
+        file_already_downloaded = file_is_done(self.journal, 'native', filepath)
         if file_already_downloaded:
             return filepath
 
-        # Test purpose
-        if not autofetch:
-            raise NativeFileUnfetchedException()
+        # Only one thread or process downloads a given file, the others wait and reuse it
+        with file_lock(f"{filepath}.lock"):
+            if os.path.isfile(filepath):
+                logger.debug(f"[EXTRACTOR] {filepath} downloaded by another requester")
+                if not file_is_done(self.journal, 'native', filepath):
+                    # e.g. downloaded by ingest_native_files
+                    self.record_native_file(filepath)
+                return filepath
+
+            # File downloaded by another extraction
+            if self.shared_store is not None and self.shared_store.fetch(os.path.basename(filepath), filepath):
+                self.record_native_file(filepath)
+                return filepath
+
+            # Test purpose
+            if not autofetch:
+                raise NativeFileUnfetchedException()
+
+            # Try every combinations of resource description possible, starting with the one that worked last
+            # resource description = model description in Vortex
+            last_exception = None
+            logger.info("[EXTRACTOR] Downloading native file ...")
+            for resource_description in self.variant_memory.sort(self._get_vortex_resource_description(date, term)):
+                try:
+                    if 'local' in resource_description:
+                        # Download in a temporary file so that a native file is never seen incomplete
+                        local = resource_description['local']
+                        r = usevortex.get_resources(getmode='epygram', **dict(resource_description, local=f"{local}.part"))
+                        os.replace(f"{local}.part", local)
+                    else:
+                        r = usevortex.get_resources(getmode='epygram', **resource_description)
+                    self.variant_memory.remember(resource_description)
+                    self.record_native_file(filepath)
+                    if self.shared_store is not None:
+                        self.shared_store.publish(filepath)
+                    logger.info("[EXTRACTOR] Downloading finished.")
+                    logger.info(f"[EXTRACTOR] Filepath: {filepath}.")
+                    return filepath
+                except Exception as e:
+                    last_exception = e
+
+            # If not combination works, raise the error
+            raise last_exception
+
 
-        # Try every combinations of resource description possible
-        # resource description = model description in Vortex
-        last_exception = None
-        logger.info("[EXTRACTOR] Downloading native file ...")
-        for resource_description in self._get_vortex_resource_description(date, term):
+class NativeFilePrefetcher:
+    """
+    Downloads native files of the next time steps in a thread pool while the current time step is computed.
+
+    This permits to overlap transfer time on Hendrix with decoding and computation time.
+
+    With tape_order=True, downloads are planned by blocks of depth time steps, and the files of a block are
+    downloaded in the order of their path on Hendrix (as given by vortex 'locate'). Files sharing a directory
+    (hence usually a tape) are requested one after the other, while time steps are still computed in time order.
+    """
+
+    def __init__(self, readers, depth=2, workers=2, tape_order=False, locate_cache=None):
+        """
+        :param readers: List of AromeHendrixReader (one for each model and member extracted)
+        :param depth: Number of time steps downloaded in advance
+        :param workers: Number of simultaneous downloads
+        :param tape_order: Download files of the next depth time steps in the order of their path on Hendrix
+        :param locate_cache: VortexLocateCache used to find paths on Hendrix when tape_order is True (optional)
+        """
+        self.readers = readers
+        self.depth = depth
+        self.workers = workers
+        self.tape_order = tape_order
+        self.locate_cache = locate_cache if locate_cache is not None else VortexLocateCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+
+    def get_archive_path(self, reader, date, term):
+        """Path on Hendrix of a native file ('' if it can't be located, such files are downloaded first)"""
+        resource_description = reader.variant_memory.sort(reader._get_vortex_resource_description(date, term))[0]
+        try:
+            return self.locate_cache.locate(resource_description)[0].split(':')[-1]
+        except Exception as e:
+            logger.debug(f"[PREFETCH] Can't locate {reader.get_path_file_in_native(date, term)}: {e}")
+            return ''
+
+    def schedule(self, dates_and_terms):
+        """
+        Submit downloads for the next time steps (at most self.depth time steps).
+
+        :param dates_and_terms: List of (date, term) that will be computed next, in order.
+        """
+        jobs = [(reader, date, term)
+                for date, term in dates_and_terms[:self.depth]
+                for reader in self.readers]
+        if self.tape_order:
+            if any(reader.get_path_file_in_native(date, term) in self.futures for reader, date, term in jobs):
+                # The current block is not downloaded yet
+                return
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                archive_paths = list(executor.map(lambda job: self.get_archive_path(*job), jobs))
+            jobs = [job for _, job in sorted(zip(archive_paths, jobs), key=lambda item: item[0])]
+        for reader, date, term in jobs:
+            filepath = reader.get_path_file_in_native(date, term)
+            if filepath not in self.futures:
+                logger.debug(f"[PREFETCH] Scheduled {filepath}")
+                self.futures[filepath] = self.executor.submit(reader.get_native_file, date, term)
+
+    def wait(self, date, term):
+        """
+        Wait until native files of a time step are downloaded.
+
+        If a download failed, the error is logged and the file will be downloaded again by the extraction itself
+        (and the retry decorator will handle Hendrix problems as usual).
+
+        :param date: Run time.
+        :param term: Forecast lead time.
+        """
+        for reader in self.readers:
+            filepath = reader.get_path_file_in_native(date, term)
+            future = self.futures.pop(filepath, None)
+            if future is None:
+                continue
             try:
-                r = usevortex.get_resources(getmode='epygram', **resource_description)
-                logger.info("[EXTRACTOR] Downloading finished.")
-                logger.info(f"[EXTRACTOR] Filepath: {filepath}.")
-                return filepath
+                future.result()
             except Exception as e:
-                last_exception = e
+                logger.warning(f"[PREFETCH] Download of {filepath} failed: {e}. It will be downloaded again.")
 
-        # If not combination works, raise the error
-        raise last_exception
+    def shutdown(self):
+        """Cancel pending downloads and stop threads"""
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.futures = {}
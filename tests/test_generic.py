@@ -0,0 +1,549 @@
+import os
+import threading
+from types import SimpleNamespace
+
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+from datetime import datetime
+
+from extracthendrix import generic
+from extracthendrix.generic import SubgridIndexCache, OpenedFilesCache, PreviousTermWindow, \
+    ReadCacheMemo, TimeSteps, MemberProcessPool, ComputedValues, \
+    AromeCacheManager, FolderLayout, StackedReadCache, NetcdfAppender, cast_to_float32, validity_date, \
+    CO2AIR, FORC_TIME_STEP
+from extracthendrix.config.variables.utils import NativeVariable
+
+
+class FakeGeometry:
+    """Mimics an epygram geometry and counts calls to ll2ij"""
+
+    name = 'regular_lonlat'
+    dimensions = {'X': 741, 'Y': 521}
+
+    def __init__(self):
+        self.nb_calls = 0
+
+    def ll2ij(self, lon, lat):
+        self.nb_calls += 1
+        return (lon * 10, lat * 10)
+
+
+def test_subgrid_indices_are_computed_once_and_persisted(tmp_path):
+    filepath = os.path.join(str(tmp_path), "subgrid_indices.json")
+    geometry = FakeGeometry()
+    subgrid_indices = SubgridIndexCache(filepath)
+    indices = subgrid_indices.get_indices('ARPEGE', geometry, 'alp')
+    assert subgrid_indices.get_indices('ARPEGE', geometry, 'alp') == indices
+    assert geometry.nb_calls == 2
+    assert os.path.isfile(filepath)
+
+    # A later extraction reads indices from the file
+    other_geometry = FakeGeometry()
+    assert SubgridIndexCache(filepath).get_indices('ARPEGE', other_geometry, 'alp') == indices
+    assert other_geometry.nb_calls == 0
+
+
+class FakeDataset:
+    """Mimics a xarray dataset opened from a file"""
+
+    def __init__(self, nbytes=10):
+        self.nbytes = nbytes
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_opened_files_cache_closes_least_recently_used():
+    opened_files = OpenedFilesCache(max_files=2)
+    first, second, third = FakeDataset(), FakeDataset(), FakeDataset()
+    opened_files.put("first.nc", first)
+    opened_files.put("second.nc", second)
+    assert opened_files.get("first.nc") is first
+    opened_files.put("third.nc", third)
+    assert second.closed and not first.closed
+    assert opened_files.get("second.nc") is None
+    assert opened_files.stats()['hits'] == 1
+    assert opened_files.stats()['misses'] == 1
+    assert opened_files.stats()['evictions'] == 1
+
+
+def test_opened_files_cache_bounded_by_size():
+    opened_files = OpenedFilesCache(max_files=None, max_bytes=25)
+    datasets = [FakeDataset(nbytes=10) for _ in range(3)]
+    for i, dataset in enumerate(datasets):
+        opened_files.put(f"{i}.nc", dataset)
+    assert datasets[0].closed
+    assert len(opened_files) == 2
+    opened_files.clear()
+    assert all(dataset.closed for dataset in datasets)
+
+
+def test_previous_term_window_returns_arrays_of_previous_term():
+    window = PreviousTermWindow()
+    date_ = datetime(2022, 6, 17)
+    window.roll(date_, 1)
+    window.store(date_, 1, 'alp', 'SURFACCNEIGE', 1.)
+    assert window.get(date_, 1, 'alp', 'SURFACCNEIGE') is None
+    window.roll(date_, 2)
+    assert window.get(date_, 1, 'alp', 'SURFACCNEIGE') == 1.
+    assert window.get(date_, 1, 'pyr', 'SURFACCNEIGE') is None
+    window.roll(date_, 3)
+    assert window.get(date_, 1, 'alp', 'SURFACCNEIGE') is None
+
+
+def test_read_cache_memo_reads_native_variables_once():
+    calls = []
+
+    def read_cache(date, term, domain, native_variable):
+        calls.append(native_variable.name)
+        return len(calls)
+
+    u = NativeVariable(model_name='AROME', name='CLSVENT.ZONAL')
+    v = NativeVariable(model_name='AROME', name='CLSVENT.MERIDIEN')
+    memo = ReadCacheMemo()
+    date_ = datetime(2022, 6, 17)
+    for _ in range(2):
+        memoized_read_cache = memo.wrap(read_cache)
+        assert memoized_read_cache(date_, 1, 'alp', u) == 1
+        assert memoized_read_cache(date_, 1, 'alp', v) == 2
+    assert calls == ['CLSVENT.ZONAL', 'CLSVENT.MERIDIEN']
+    assert memo.hits == 2
+
+
+def test_time_steps_shift_for_decumulation():
+    date_ = datetime(2022, 6, 17)
+    time_steps = TimeSteps([(date_, 1), (date_, 2), (date_, 3)])
+    assert list(time_steps - 1) == [None, (date_, 1), (date_, 2)]
+    assert time_steps.validity_dates()[-1] == datetime(2022, 6, 17, 3)
+
+
+class FakeComputer:
+    """Mimics ComputedValues in worker processes"""
+
+    def __init__(self, members=None, **kwargs):
+        self.members = members
+        self.cache_managers = {}
+
+    def compute_member(self, run, term, member):
+        return {'alp': (os.getpid(), self.members)}
+
+    def delete_native_files(self, date=None, term=None):
+        pass
+
+
+def test_members_are_computed_by_worker_processes(monkeypatch):
+    monkeypatch.setattr("extracthendrix.generic.ComputedValues", FakeComputer)
+    pool = MemberProcessPool({}, [1, 2, 3], workers=2)
+    results = pool.compute(datetime(2022, 6, 17), 1, [1, 2, 3])
+    pool.shutdown()
+
+    # Each worker owns the same members during the whole extraction
+    assert results[1]['alp'][1] == results[3]['alp'][1] == [1, 3]
+    assert results[2]['alp'][1] == [2]
+    assert results[1]['alp'][0] == results[3]['alp'][0] != results[2]['alp'][0]
+    assert os.getpid() not in {result['alp'][0] for result in results.values()}
+
+
+def test_domains_are_computed_simultaneously():
+    domains = ["alp", "pyr", "corsica"]
+    # Each domain waits for the others: this only succeeds if domains are computed simultaneously
+    barrier = threading.Barrier(len(domains), timeout=5)
+
+    def compute_domain(domain):
+        barrier.wait()
+        return domain.upper()
+
+    computer = SimpleNamespace(domain_workers=3)
+    assert ComputedValues.map_domains(computer, compute_domain, domains) == ["ALP", "PYR", "CORSICA"]
+    computer = SimpleNamespace(domain_workers=1)
+    assert ComputedValues.map_domains(computer, str.upper, domains) == ["ALP", "PYR", "CORSICA"]
+
+
+def test_lazy_read_cache_builds_a_graph(tmp_path):
+    cache_manager = AromeCacheManager(FolderLayout(str(tmp_path)), domain=['alp'], model='AROME', lazy=True)
+    snow = NativeVariable(model_name='AROME', name='SURFACCNEIGE')
+    date_ = datetime(2022, 6, 17)
+    steps = [(date_, term) for term in [1, 2, 3]]
+    for _, term in steps:
+        xr.Dataset({'SURFACCNEIGE': (('yy', 'xx'), np.full((2, 3), float(term)))},
+                   coords={'latitude': (('yy', 'xx'), np.zeros((2, 3))),
+                           'longitude': (('yy', 'xx'), np.zeros((2, 3)))}
+                   ).to_netcdf(cache_manager.get_path_file_in_cache(date_, term, 'alp'))
+
+    stacked = StackedReadCache(cache_manager.read_cache)(None, TimeSteps(steps), 'alp', snow)
+    assert stacked.chunks is not None
+    assert stacked.sum().compute() == 2 * 3 * (1 + 2 + 3)
+    cache_manager.forget_opened_files()
+
+
+def test_float32_is_chosen_at_read_time(tmp_path):
+    cache_manager = AromeCacheManager(FolderLayout(str(tmp_path)), domain=['alp'], model='AROME', dtype='32bits')
+    temperature = NativeVariable(model_name='AROME', name='CLSTEMPERATURE')
+    date_ = datetime(2022, 6, 17)
+    xr.Dataset({'CLSTEMPERATURE': (('yy', 'xx'), np.full((2, 3), 273.15))},
+               coords={'latitude': (('yy', 'xx'), np.zeros((2, 3))),
+                       'longitude': (('yy', 'xx'), np.zeros((2, 3)))}
+               ).to_netcdf(cache_manager.get_path_file_in_cache(date_, 1, 'alp'))
+
+    temperature_in_degree_c = cache_manager.read_cache(date_, 1, 'alp', temperature) - 273.15
+    assert temperature_in_degree_c.dtype == np.float32
+    cache_manager.forget_opened_files()
+
+    # Arrays already in float32 are not copied when final files are written
+    dataset = xr.Dataset({'Tair': temperature_in_degree_c, 'UREF': (('yy', 'xx'), np.full((2, 3), 10))})
+    data = dataset['Tair'].data
+    dataset_in_float32 = cast_to_float32(dataset)
+    assert dataset_in_float32['Tair'].data is data
+    assert dataset_in_float32['UREF'].dtype == np.float32
+    # The dataset given is not modified
+    assert dataset['UREF'].dtype != np.float32
+
+
+class FakeField:
+    """Mimics an epygram field on the grid of AROME"""
+
+    spectral = False
+
+    def __init__(self, name, data):
+        self.fid = {'FA': name}
+        self.data = data
+
+    def getdata(self):
+        return self.data
+
+    def setdata(self, data):
+        self.data = data
+
+    def extract_subarray(self, first_i, last_i, first_j, last_j):
+        field = FakeField(self.fid['FA'], self.data[first_j:last_j + 1, first_i:last_i + 1])
+        field.fid = dict(self.fid)
+        return field
+
+
+class FakeNativeResource:
+    """Mimics an epygram resource of a native file and counts fields read"""
+
+    def __init__(self):
+        self.fields_read = []
+
+    def readfield(self, name):
+        self.fields_read.append(name)
+        return FakeField(name, np.add.outer(np.arange(800.), np.arange(1200.)) + len(name))
+
+    def close(self):
+        pass
+
+
+class FakeNetcdfResource:
+    """Mimics an epygram netCDF resource written in cache"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.fields = {}
+
+    def behave(self, **kwargs):
+        pass
+
+    def writefield(self, field):
+        self.fields[field.fid['netCDF']] = (('yy', 'xx'), field.getdata())
+
+    def close(self):
+        shape = next(iter(self.fields.values()))[1].shape
+        xr.Dataset(self.fields, coords={'latitude': (('yy', 'xx'), np.zeros(shape)),
+                                        'longitude': (('yy', 'xx'), np.zeros(shape))}).to_netcdf(self.filepath)
+
+
+class FakeCumulatedNativeResource(FakeNativeResource):
+    """Mimics an epygram resource of a native file whose fields are cumulated since the start of the run"""
+
+    def __init__(self, filepath):
+        super().__init__()
+        with open(filepath) as f:
+            self.term = int(f.read())
+
+    def readfield(self, name):
+        field = super().readfield(name)
+        field.setdata(field.getdata() * self.term)
+        return field
+
+
+def fake_hendrix(monkeypatch):
+    """Native files are "downloaded" by vortex and decoded by epygram without Hendrix"""
+    def get_resources(getmode, **resource_description):
+        with open(resource_description['local'], 'w') as f:
+            f.write(str(resource_description['term']))
+
+    def resource(filepath, mode, fmt=None):
+        return FakeCumulatedNativeResource(filepath) if mode == 'r' else FakeNetcdfResource(filepath)
+
+    monkeypatch.setattr("extracthendrix.readers.usevortex.get_resources", get_resources)
+    monkeypatch.setattr(generic.epygram, "formats", SimpleNamespace(resource=resource))
+
+
+def test_single_pass_reads_native_fields_once_for_all_domains(tmp_path, monkeypatch):
+    native_resource = FakeNativeResource()
+
+    def resource(filepath, mode, fmt=None):
+        return native_resource if mode == 'r' else FakeNetcdfResource(filepath)
+
+    monkeypatch.setattr(generic.epygram, "formats", SimpleNamespace(resource=resource))
+    native_variables = [NativeVariable(model_name='AROME', name='CLSTEMPERATURE'),
+                        NativeVariable(model_name='AROME', name='SURFACCNEIGE')]
+    date_ = datetime(2022, 6, 17)
+
+    cache_files = {}
+    for single_pass_domains in [True, False]:
+        cache_manager = AromeCacheManager(
+            FolderLayout(str(tmp_path / str(single_pass_domains))), domain=['alp', 'pyr'],
+            native_variables=native_variables, model='AROME', autofetch_native=True,
+            single_pass_domains=single_pass_domains)
+        open(cache_manager.extractor.get_path_file_in_native(date_, 1), 'w').close()
+        native_resource.fields_read = []
+        for domain in ['alp', 'pyr']:
+            cache_manager.put_in_cache(date_, 1, domain)
+        if single_pass_domains:
+            assert native_resource.fields_read == ['CLSTEMPERATURE', 'SURFACCNEIGE']
+        else:
+            assert native_resource.fields_read == ['CLSTEMPERATURE', 'SURFACCNEIGE'] * 2
+        cache_files[single_pass_domains] = {
+            domain: cache_manager.get_path_file_in_cache(date_, 1, domain) for domain in ['alp', 'pyr']}
+
+    for domain, shape in [('alp', (226, 176)), ('pyr', (126, 306))]:
+        with xr.open_dataset(cache_files[True][domain]) as single_pass, \
+                xr.open_dataset(cache_files[False][domain]) as per_domain:
+            xr.testing.assert_identical(single_pass, per_domain)
+            assert single_pass['SURFACCNEIGE'].shape == shape
+
+
+def computed_arrays(term):
+    """Computed variables of a time step, as returned by ComputedValues.compute_member"""
+    coords = {'latitude': (('yy', 'xx'), np.linspace(44., 45., 6).reshape(2, 3)),
+              'longitude': (('yy', 'xx'), np.linspace(5., 7., 6).reshape(2, 3))}
+    return {'Tair': xr.DataArray(np.full((2, 3), 270. + term, dtype=np.float32), dims=('yy', 'xx'),
+                                 coords=coords, attrs={'units': 'K'}),
+            'Snowf': xr.DataArray(np.arange(6, dtype=np.float32).reshape(2, 3) * term, dims=('yy', 'xx'),
+                                  coords=coords, attrs={'units': 'kg/m2/s'})}
+
+
+def write_final_files(tmp_path, terms, dtype='32bits'):
+    """Write the final file of a few time steps by streaming them, and by concatenating files in _computed_"""
+    run = datetime(2022, 6, 17)
+    streamed = str(tmp_path / "streamed.nc")
+    writer = NetcdfAppender(streamed, dtype=dtype, surfex=True)
+    for term in terms:
+        writer.append(validity_date(run, term), computed_arrays(term))
+    writer.close()
+
+    concatenated = str(tmp_path / "concatenated.nc")
+    computer = SimpleNamespace(dtype=dtype, computed_files={(None, 'alp'): []},
+                               get_path_file_in_final=lambda *args: concatenated,
+                               record=lambda kind, filepath: None)
+    for term in terms:
+        filepath = str(tmp_path / f"computed_{term}.nc")
+        variables_storage = dict(computed_arrays(term), time=validity_date(run, term))
+        ComputedValues.save_computed_vars_to_netcdf(computer, filepath, variables_storage)
+        computer.computed_files[(None, 'alp')].append(filepath)
+    ComputedValues._concat_files_and_save_netcdf(computer, "2022061700", None, 'alp')
+    return streamed, concatenated
+
+
+@pytest.mark.parametrize("dtype", ['32bits', None])
+def test_streamed_final_file_matches_concatenated_file(tmp_path, dtype):
+    streamed, concatenated = write_final_files(tmp_path, [1, 2, 3], dtype)
+    assert not os.path.isfile(f"{streamed}.part")
+
+    with xr.open_dataset(streamed) as stream, xr.open_dataset(concatenated) as concat:
+        assert set(stream.variables) == set(concat.variables)
+        assert stream.attrs == concat.attrs
+        np.testing.assert_array_equal(stream.time.values, concat.time.values)
+        for name in concat.variables:
+            assert stream[name].dims == concat[name].dims, name
+            assert stream[name].dtype == concat[name].dtype, name
+            assert stream[name].attrs == concat[name].attrs, name
+            if name != 'time':
+                np.testing.assert_allclose(stream[name].values, concat[name].values, err_msg=name)
+
+
+def test_final_files_have_surfex_layout(tmp_path):
+    for filepath in write_final_files(tmp_path, [1, 2]):
+        with xr.open_dataset(filepath) as ds:
+            assert {'LAT', 'LON'} <= set(ds.coords)
+            assert not {'latitude', 'longitude'} & set(ds.variables)
+            assert ds.attrs['FORC_TIME_STEP'] == FORC_TIME_STEP
+            assert ds['FRC_TIME_STP'].dims == () and ds['FRC_TIME_STP'] == FORC_TIME_STEP
+            for name, value in [('UREF', 10), ('ZREF', 2), ('slope', 0), ('aspect', 0)]:
+                assert ds[name].dims == ('xx', 'yy'), name
+                assert (ds[name] == value).all(), name
+            for name, value in [('CO2air', CO2AIR), ('Wind_DIR', 0)]:
+                assert ds[name].dims == ('time', 'xx', 'yy'), name
+                np.testing.assert_allclose(ds[name].values, value, rtol=1e-6, err_msg=name)
+            np.testing.assert_allclose(ds['Tair'].values[:, 0, 0], [271., 272.])
+
+
+def test_constant_surfex_fields_are_compressed(tmp_path):
+    for filepath in write_final_files(tmp_path, [1, 2]):
+        with netCDF4.Dataset(filepath) as ds:
+            assert ds.dimensions['time'].isunlimited()
+            for name in ['CO2air', 'Wind_DIR', 'UREF', 'ZREF', 'slope', 'aspect']:
+                assert ds.variables[name].filters()['zlib'], name
+                assert ds.variables[name].dtype == np.float32, name
+            for name in ['CO2air', 'Wind_DIR']:
+                # One chunk per time step
+                assert ds.variables[name].chunking() == [1, 3, 2], name
+            assert ds.variables['UREF'][:].min() == ds.variables['UREF'][:].max() == 10
+            np.testing.assert_allclose(ds.variables['CO2air'][:], CO2AIR, rtol=1e-6)
+
+
+def test_files_being_downloaded_are_not_deleted(tmp_path):
+    cache_manager = AromeCacheManager(FolderLayout(str(tmp_path)), domain=['alp'], model='AROME')
+    date_ = datetime(2022, 6, 17)
+    native_files = [cache_manager.extractor.get_path_file_in_native(date_, term) for term in [1, 2, 3]]
+    for native_file in native_files[:2]:
+        open(native_file, 'w').close()
+        open(f"{native_file}.lock", 'w').close()
+    # Term 3 is being downloaded by another thread
+    open(f"{native_files[2]}.lock", 'w').close()
+    open(f"{native_files[2]}.part", 'w').close()
+
+    cache_manager.delete_native_files(date_, 1)
+    assert not os.path.isfile(native_files[0])
+    cache_manager.delete_native_files()
+    assert sorted(os.listdir(cache_manager.folderLayout._native_)) == sorted(
+        [os.path.basename(f"{native_file}.lock") for native_file in native_files]
+        + [os.path.basename(f"{native_files[2]}.part")])
+
+
+def test_files_in_cache_are_read_while_another_time_step_is_put_in_cache(tmp_path, monkeypatch):
+    cache_manager = AromeCacheManager(FolderLayout(str(tmp_path)), domain=['alp'], model='AROME')
+    temperature = NativeVariable(model_name='AROME', name='CLSTEMPERATURE')
+    date_ = datetime(2022, 6, 17)
+
+    def write_file_in_cache(term):
+        xr.Dataset({'CLSTEMPERATURE': (('yy', 'xx'), np.full((2, 3), 273.15 + term))},
+                   coords={'latitude': (('yy', 'xx'), np.zeros((2, 3))),
+                           'longitude': (('yy', 'xx'), np.zeros((2, 3)))}
+                   ).to_netcdf(cache_manager.get_path_file_in_cache(date_, term, 'alp'))
+    write_file_in_cache(1)
+
+    # Term 2 is being downloaded and decoded in another thread
+    started, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(cache_manager.extractor, "get_native_file", lambda *args, **kwargs: None)
+
+    def put_in_cache(date, term, domain):
+        started.set()
+        release.wait(5)
+        write_file_in_cache(term)
+    monkeypatch.setattr(cache_manager, "put_in_cache", put_in_cache)
+    results = {}
+
+    def read_cache(term):
+        results[term] = cache_manager.read_cache(date_, term, 'alp', temperature)
+    thread = threading.Thread(target=read_cache, args=(2,))
+    thread.start()
+    assert started.wait(5)
+
+    reader = threading.Thread(target=read_cache, args=(1,))
+    reader.start()
+    reader.join(2)
+    released_after_read = not reader.is_alive()
+    release.set()
+    thread.join()
+    reader.join()
+    cache_manager.forget_opened_files()
+    assert released_after_read
+    assert (results[1] == 274.15).all()
+    assert (results[2] == 275.15).all()
+
+
+def test_native_files_read_for_decumulation_are_deleted(tmp_path, monkeypatch):
+    fake_hendrix(monkeypatch)
+    folder_layout = FolderLayout(str(tmp_path))
+    computer = ComputedValues(folder_layout, domain=['alp'], computed_vars=['Rainf'], model='AROME',
+                              autofetch_native=True)
+    date_ = datetime(2022, 6, 17)
+    # Extraction starts at term 2: the native file of term 1 is downloaded for decumulation
+    computer.compute(date_, 2)
+
+    cache_manager = computer.cache_managers[('AROME', None)]
+    with xr.open_dataset(computer.computed_files[(None, 'alp')][0]) as computed, \
+            xr.open_dataset(cache_manager.get_path_file_in_cache(date_, 1, 'alp')) as first_term:
+        # Fields are cumulated linearly: decumulated values are those of term 1
+        np.testing.assert_allclose(computed['Rainf'].values[0], first_term['SURFACCPLUIE'].values / 3600)
+    assert [f for f in os.listdir(folder_layout._native_) if not f.endswith('.lock')] == []
+
+
+def test_lazy_batch_leaves_no_final_file_when_computation_fails(tmp_path, monkeypatch):
+    fake_hendrix(monkeypatch)
+    computer = ComputedValues(FolderLayout(str(tmp_path)), domain=['alp'], computed_vars=['Rainf'], model='AROME',
+                              autofetch_native=True, lazy=True)
+    date_ = datetime(2022, 6, 17)
+    read_cache = AromeCacheManager.read_cache
+
+    def fail(block):
+        raise OSError("Download failed")
+
+    def read_cache_failing_when_computed(self, *args):
+        data = read_cache(self, *args)
+        return data.copy(data=data.data.map_blocks(fail, dtype=data.dtype))
+
+    monkeypatch.setattr(AromeCacheManager, "read_cache", read_cache_failing_when_computed)
+    with pytest.raises(OSError):
+        computer.compute_batch([(date_, 1), (date_, 2)], "2022061700")
+    computer.clean_cache_folder()
+    assert os.listdir(computer.folderLayout._final_) == []
+    assert not computer.files_are_in_final("2022061700")
+
+
+def extract_batches(folder, batches, compute_batch):
+    """Extract Tair and Rainf batch by batch, as in configreader._execute"""
+    computer = ComputedValues(FolderLayout(folder), domain=['alp'], computed_vars=['Tair', 'Rainf'], model='AROME',
+                              autofetch_native=True)
+    for time_tag, steps in batches.items():
+        if compute_batch:
+            computer.compute_batch(steps, time_tag)
+        else:
+            for date_, term in steps:
+                computer.compute(date_, term)
+            computer.concat_and_clean_computed_folder(time_tag)
+        computer.clean_cache_folder()
+    return computer
+
+
+def test_batch_matches_term_by_term_extraction(tmp_path, monkeypatch):
+    fake_hendrix(monkeypatch)
+    date_ = datetime(2022, 6, 17)
+    # Rainf of term 3 is decumulated with term 2, extracted in the previous batch
+    batches = {"batch1": [(date_, 1), (date_, 2)], "batch2": [(date_, 3), (date_, 4)]}
+    by_term = extract_batches(str(tmp_path / "term"), batches, compute_batch=False)
+    by_batch = extract_batches(str(tmp_path / "batch"), batches, compute_batch=True)
+
+    for time_tag in batches:
+        with xr.open_dataset(by_term.get_path_file_in_final(time_tag, None, 'alp')) as expected, \
+                xr.open_dataset(by_batch.get_path_file_in_final(time_tag, None, 'alp')) as computed:
+            xr.testing.assert_allclose(computed, expected)
+            assert computed.attrs == expected.attrs
+            assert {name: computed[name].dtype for name in computed.variables} == \
+                   {name: expected[name].dtype for name in expected.variables}
+            # Precipitation is constant in the fake native files
+            np.testing.assert_allclose(computed['Rainf'].values[0], computed['Rainf'].values[1])
+
+
+def test_batch_leaves_no_final_file_when_writing_fails(tmp_path, monkeypatch):
+    fake_hendrix(monkeypatch)
+    computer = ComputedValues(FolderLayout(str(tmp_path)), domain=['alp'], computed_vars=['Rainf'], model='AROME',
+                              autofetch_native=True)
+    to_netcdf = xr.Dataset.to_netcdf
+
+    def to_netcdf_failing_in_final(self, path, *args, **kwargs):
+        to_netcdf(self, path, *args, **kwargs)
+        if os.path.dirname(path) == computer.folderLayout._final_:
+            raise OSError("Disk quota exceeded")
+
+    monkeypatch.setattr(xr.Dataset, "to_netcdf", to_netcdf_failing_in_final)
+    with pytest.raises(OSError):
+        computer.compute_batch([(datetime(2022, 6, 17), 1), (datetime(2022, 6, 17), 2)], "batch1")
+    assert not os.path.isfile(computer.get_path_file_in_final("batch1", None, 'alp'))
+    assert not computer.files_are_in_final("batch1")
@@ -0,0 +1,56 @@
+import os
+
+from extracthendrix.journal import WorkJournal, file_is_done
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+
+
+def test_journal_records_and_forgets_files(tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+    journal = WorkJournal(journal_path)
+    for name in ["a.nc", "b.nc", "c.nc"]:
+        write_file(str(tmp_path / name), 10)
+        journal.record('computed', str(tmp_path / name))
+    journal.record('final', str(tmp_path / "a.nc"))
+    journal.forget('computed', str(tmp_path / "a.nc"))
+
+    assert not journal.contains('computed', str(tmp_path / "a.nc"))
+    assert journal.contains('computed', str(tmp_path / "b.nc"))
+    assert journal.get('final', str(tmp_path / "a.nc"))['size'] == 10
+
+    # The journal is read again when the extraction is relaunched, files changed since are forgotten
+    os.remove(str(tmp_path / "b.nc"))
+    write_file(str(tmp_path / "c.nc"), 5)
+    write_file(str(tmp_path / "d.nc"), 10)
+    journal.record('computed', str(tmp_path / "d.nc"))
+    journal = WorkJournal(journal_path)
+    assert not file_is_done(journal, 'computed', str(tmp_path / "a.nc"))
+    assert not file_is_done(journal, 'computed', str(tmp_path / "b.nc"))
+    assert not file_is_done(journal, 'computed', str(tmp_path / "c.nc"))
+    assert file_is_done(journal, 'computed', str(tmp_path / "d.nc"))
+    # Files are checked once, when the journal is read
+    os.remove(str(tmp_path / "d.nc"))
+    assert file_is_done(journal, 'computed', str(tmp_path / "d.nc"))
+
+    journal.forget('computed')
+    assert not journal.contains('computed', str(tmp_path / "d.nc"))
+    assert journal.contains('final', str(tmp_path / "a.nc"))
+
+    journal.delete()
+    assert not os.path.isfile(journal_path)
+
+
+def test_journal_scans_folders_of_previous_extraction(tmp_path):
+    cache = tmp_path / "_cache_"
+    cache.mkdir()
+    write_file(str(cache / "a.nc"), 10)
+    write_file(str(cache / "b.nc.part"), 10)
+
+    journal = WorkJournal(str(tmp_path / "journal.jsonl"), folders={'cache': str(cache)})
+
+    assert journal.contains('cache', str(cache / "a.nc"))
+    assert not journal.contains('cache', str(cache / "b.nc.part"))
+    assert WorkJournal(str(tmp_path / "journal.jsonl")).contains('cache', str(cache / "a.nc"))
@@ -0,0 +1,83 @@
+import os
+import errno
+
+from extracthendrix.native_store import SharedNativeStore
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+
+
+def test_shared_store_fetch_and_publish(tmp_path):
+    store = SharedNativeStore(str(tmp_path / "store"))
+    destination = str(tmp_path / "native_a.fa")
+    assert not store.fetch("native_a.fa", destination)
+
+    downloaded = str(tmp_path / "downloaded_a.fa")
+    write_file(downloaded, 10)
+    os.rename(downloaded, destination)
+    store.publish(destination)
+    os.remove(destination)
+
+    assert store.fetch("native_a.fa", destination)
+    assert os.path.getsize(destination) == 10
+
+
+def test_shared_store_evicts_least_recently_used(tmp_path):
+    store = SharedNativeStore(str(tmp_path / "store"), max_bytes=25)
+    for i, name in enumerate(["a.fa", "b.fa", "c.fa"]):
+        filepath = str(tmp_path / name)
+        write_file(filepath, 10)
+        store.publish(filepath)
+        os.utime(store.get_path(name), (i, i))
+        if name == "b.fa":
+            # a.fa is used again, b.fa becomes the least recently used
+            store.fetch("a.fa", str(tmp_path / "a_bis.fa"))
+
+    assert sorted(os.listdir(store.path)) == ['.lock', 'a.fa', 'c.fa']
+
+
+def belong_to_another_user(monkeypatch, paths):
+    """
+    Files can be read but not written, touched or deleted by the current user (e.g. files of another user
+    in a folder with the sticky bit). Permissions are not checked for root: errors are also raised explicitly.
+    """
+    paths = {os.path.abspath(path) for path in paths}
+    for path in paths:
+        os.chmod(path, 0o444)
+
+    def deny(function, is_write=lambda *args: True):
+        def wrapper(path, *args, **kwargs):
+            if os.path.abspath(path) in paths and is_write(*args):
+                raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+            return function(path, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(os, 'utime', deny(os.utime))
+    monkeypatch.setattr(os, 'remove', deny(os.remove))
+    # O_EXCL fails with FileExistsError before permissions are checked
+    monkeypatch.setattr(os, 'open', deny(
+        os.open, lambda flags, *args: flags & (os.O_WRONLY | os.O_RDWR) and not flags & os.O_EXCL))
+
+
+def test_shared_store_with_files_of_another_user(tmp_path, monkeypatch):
+    store = SharedNativeStore(str(tmp_path / "store"), max_bytes=15)
+    filepath = str(tmp_path / "a.fa")
+    write_file(filepath, 10)
+    store.publish(filepath)
+    # Other users of the group can use the store
+    assert os.stat(store.path).st_mode & 0o2070 == 0o2070
+    assert os.stat(store.lock_path).st_mode & 0o060 == 0o060
+
+    belong_to_another_user(monkeypatch, [store.lock_path, store.get_path("a.fa")])
+
+    # The file is used even if it can't be marked as recently used
+    assert store.fetch("a.fa", str(tmp_path / "a_bis.fa"))
+    assert os.path.getsize(str(tmp_path / "a_bis.fa")) == 10
+
+    # Files that can't be deleted are kept when the store is too large
+    filepath = str(tmp_path / "b.fa")
+    write_file(filepath, 10)
+    store.publish(filepath)
+    assert "a.fa" in os.listdir(store.path)
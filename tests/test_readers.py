@@ -0,0 +1,324 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from extracthendrix.readers import NativeFilePrefetcher, FTPSessionPool, DirectoryListingCache, \
+    return_path_if_exists_on_hendrix, VortexLocateCache, locate_resources, \
+    get_models_registry, get_all_resource_descriptions, ResourceVariantMemory, \
+    get_members, download_native_files, AromeHendrixReader, ingest_native_files, \
+    PrestagingPipeline
+from extracthendrix.generic import FolderLayout
+
+
+class FakeReader:
+    """Mimics AromeHendrixReader without accessing Hendrix"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.downloaded = []
+
+    def get_path_file_in_native(self, date, term):
+        return os.path.join(self.folder, f"{date.strftime('%Y%m%d%H')}_term{term}.fa")
+
+    def get_native_file(self, date, term):
+        filepath = self.get_path_file_in_native(date, term)
+        with open(filepath, 'w') as f:
+            f.write("native")
+        self.downloaded.append((date, term))
+        return filepath
+
+
+class FakeArchivedReader(FakeReader):
+    """FakeReader whose files are located in a directory of Hendrix"""
+
+    def __init__(self, folder, archive_folder, downloads):
+        super().__init__(folder)
+        self.archive_folder = archive_folder
+        self.downloads = downloads
+        self.variant_memory = ResourceVariantMemory()
+
+    def get_path_file_in_native(self, date, term):
+        return os.path.join(self.folder, f"{self.archive_folder}_{date.strftime('%Y%m%d%H')}_term{term}.fa")
+
+    def _get_vortex_resource_description(self, date, term):
+        return [dict(archive_folder=self.archive_folder, date=date, term=term)]
+
+    def get_native_file(self, date, term):
+        self.downloads.append(os.path.basename(self.get_path_file_in_native(date, term)))
+        return super().get_native_file(date, term)
+
+
+def test_prefetcher_downloads_in_tape_order(tmp_path, monkeypatch):
+    def get_resources(getmode=None, **resource_description):
+        return [f"hendrix.meteo.fr:/{resource_description['archive_folder']}/term{resource_description['term']}"]
+
+    monkeypatch.setattr("extracthendrix.readers.usevortex.get_resources", get_resources)
+    downloads = []
+    readers = [FakeArchivedReader(str(tmp_path), archive_folder, downloads) for archive_folder in ["b", "a"]]
+    prefetcher = NativeFilePrefetcher(readers, depth=2, workers=1, tape_order=True)
+    date_ = datetime(2022, 6, 17)
+    steps = [(date_, term) for term in range(1, 6)]
+    for index, step in enumerate(steps):
+        prefetcher.schedule(steps[index+1:])
+        prefetcher.wait(*step)
+    prefetcher.shutdown()
+
+    # Files of a block of two time steps are downloaded by directory on Hendrix
+    assert downloads == ["a_2022061700_term2.fa", "a_2022061700_term3.fa",
+                         "b_2022061700_term2.fa", "b_2022061700_term3.fa",
+                         "a_2022061700_term4.fa", "a_2022061700_term5.fa",
+                         "b_2022061700_term4.fa", "b_2022061700_term5.fa"]
+
+
+def test_prefetcher_downloads_next_terms(tmp_path):
+    reader = FakeReader(str(tmp_path))
+    prefetcher = NativeFilePrefetcher([reader], depth=2, workers=2)
+    date_ = datetime(2022, 6, 17)
+    prefetcher.schedule([(date_, 1), (date_, 2), (date_, 3)])
+    prefetcher.wait(date_, 1)
+    prefetcher.wait(date_, 2)
+    prefetcher.shutdown()
+    assert sorted(reader.downloaded) == [(date_, 1), (date_, 2)]
+    assert os.path.isfile(reader.get_path_file_in_native(date_, 2))
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    """Local FTP server standing in for Hendrix"""
+    pytest.importorskip("pyftpdlib")
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+
+    root = tmp_path / "hendrix"
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "password", str(root), perm="elradfmw")
+    handler = type("Handler", (FTPHandler,), dict(authorizer=authorizer))
+    server = FTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(timeout=0.1))
+    thread.start()
+    yield root, server.address[1]
+    server.close_all()
+    thread.join()
+
+
+def test_listing_cache_lists_each_folder_once(ftp_server, tmp_path):
+    root, port = ftp_server
+    (root / "arome").mkdir()
+    (root / "arome" / "historic.franmgsp.tar").write_text("native")
+    pool = FTPSessionPool(host="127.0.0.1", port=port, credentials=("user", None, "password"))
+    filepath = os.path.join(str(tmp_path), "hendrix_listings.json")
+    listing_cache = DirectoryListingCache(filepath, ttl=3600)
+
+    with pool.session() as ftp:
+        path = return_path_if_exists_on_hendrix(ftp, "/arome/historic.franmgsp", listing_cache)
+    assert path == "/arome/historic.franmgsp.tar"
+
+    # The folder is not listed again, the same session is reused
+    (root / "arome" / "historic.franmgsp.tar").unlink()
+    with pool.session() as ftp:
+        assert return_path_if_exists_on_hendrix(ftp, "/arome/historic.franmgsp", listing_cache) == path
+        with pytest.raises(StopIteration):
+            return_path_if_exists_on_hendrix(ftp, "/missing/file", listing_cache)
+    assert len(pool.all_sessions) == 1
+    pool.close()
+
+    # Listings are reused by a later request
+    listing_cache.save()
+    assert "/arome" in DirectoryListingCache(filepath, ttl=3600).listings
+    expired_listing_cache = DirectoryListingCache(filepath, ttl=-1)
+    assert not expired_listing_cache.is_valid(expired_listing_cache.listings["/arome"])
+
+
+def test_locate_cache_saves_locations(tmp_path, monkeypatch):
+    calls = []
+
+    def get_resources(getmode=None, **resource_description):
+        calls.append(resource_description['term'])
+        return [f"hendrix.meteo.fr:/arome/term{resource_description['term']}"]
+
+    monkeypatch.setattr("extracthendrix.readers.usevortex.get_resources", get_resources)
+    filepath = os.path.join(str(tmp_path), "vortex_locations.json")
+    resource_descriptions = [dict(model='arome', date=datetime(2022, 6, 17), term=term) for term in range(1, 5)]
+
+    locate_cache = VortexLocateCache(filepath)
+    locations = locate_resources(resource_descriptions, locate_cache, workers=2)
+    assert locations == [[f"hendrix.meteo.fr:/arome/term{term}"] for term in range(1, 5)]
+    locate_cache.save()
+
+    assert locate_resources(resource_descriptions, VortexLocateCache(filepath)) == locations
+    assert sorted(calls) == [1, 2, 3, 4]
+
+
+def test_models_registry_is_parsed_once():
+    assert get_models_registry() is get_models_registry()
+    resource_descriptions = get_all_resource_descriptions('AROME')
+    assert [rd['namespace'] for rd in resource_descriptions] == ['oper.archive.fr', 'vortex.archive.fr']
+    # Descriptions returned are copies, the registry can't be modified
+    resource_descriptions[0]['namespace'] = 'modified'
+    assert get_all_resource_descriptions('AROME')[0]['namespace'] == 'oper.archive.fr'
+    with pytest.raises(TypeError):
+        get_models_registry()['AROME']['namespace'] = ('modified',)
+
+
+def test_variant_that_worked_is_tried_first(tmp_path):
+    filepath = os.path.join(str(tmp_path), "resource_variant_AROME.json")
+    resource_descriptions = [dict(namespace=namespace, date=datetime(2022, 6, 17), term=1)
+                             for namespace in ['oper.archive.fr', 'vortex.archive.fr']]
+    variant_memory = ResourceVariantMemory(filepath)
+    assert variant_memory.sort(resource_descriptions) == resource_descriptions
+
+    variant_memory.remember(dict(resource_descriptions[1], term=2))
+    assert variant_memory.sort(resource_descriptions)[0]['namespace'] == 'vortex.archive.fr'
+    assert ResourceVariantMemory(filepath).sort(resource_descriptions)[0]['namespace'] == 'vortex.archive.fr'
+
+    # The variant that worked for a member is tried first for the other members
+    variant_memory.remember(dict(resource_descriptions[0], member=3))
+    variant_memory.remember(dict(resource_descriptions[1], member=3))
+    members_descriptions = [dict(resource_description, member=7) for resource_description in resource_descriptions]
+    assert ResourceVariantMemory(filepath).sort(members_descriptions)[0]['namespace'] == 'vortex.archive.fr'
+
+    # A truncated file is ignored
+    with open(filepath, 'w') as f:
+        f.write('{"last_su')
+    assert ResourceVariantMemory(filepath).sort(resource_descriptions) == resource_descriptions
+
+
+def test_all_members_are_extracted_only_when_asked():
+    # Without member, members of models.ini are alternatives of the resource
+    assert len(get_all_resource_descriptions('PEAROME_SURFACE')) == 2 * 16
+    assert [rd['member'] for rd in get_all_resource_descriptions('PEAROME_SURFACE', 3)] == [3, 3]
+    assert get_members([None], ['PEAROME', 'PEAROME_SURFACE']) == [None]
+    assert get_members('all', ['PEAROME', 'PEAROME_SURFACE']) == list(range(1, 17))
+    assert get_members('all', ['AROME', 'AROME_SURFACE']) == [None]
+
+
+def test_download_native_files_of_members(tmp_path):
+    readers = [FakeReader(str(tmp_path / f"mb{member}")) for member in range(3)]
+    for reader in readers:
+        os.mkdir(reader.folder)
+    date_ = datetime(2022, 6, 17)
+    filepaths = download_native_files(readers, date_, 1, workers=3)
+    assert all(os.path.isfile(filepath) for filepath in filepaths)
+
+
+def test_concurrent_requests_download_once(tmp_path, monkeypatch):
+    calls = []
+
+    def get_resources(getmode, **resource_description):
+        calls.append(resource_description)
+        time.sleep(0.2)
+        with open(resource_description['local'], 'w') as f:
+            f.write("native")
+
+    monkeypatch.setattr("extracthendrix.readers.usevortex.get_resources", get_resources)
+    layout = FolderLayout(str(tmp_path))
+    readers = [AromeHendrixReader(layout, 'AROME') for _ in range(4)]
+    date_ = datetime(2022, 6, 17)
+    threads = [threading.Thread(target=reader.get_native_file, args=(date_, 1)) for reader in readers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert os.path.isfile(readers[0].get_path_file_in_native(date_, 1))
+    assert not os.path.isfile(f"{readers[0].get_path_file_in_native(date_, 1)}.part")
+
+
+def test_ingest_prestaged_files(ftp_server, tmp_path, monkeypatch):
+    root, port = ftp_server
+    (root / "arome").mkdir()
+    for term in [1, 2]:
+        (root / "arome" / f"term{term}.fa").write_text(f"native {term}")
+
+    def get_resources(getmode=None, **resource_description):
+        return [f"hendrix.meteo.fr:/arome/term{resource_description['term']}.fa"]
+
+    monkeypatch.setattr("extracthendrix.readers.usevortex.get_resources", get_resources)
+    reader = AromeHendrixReader(FolderLayout(str(tmp_path / "work")), 'AROME', getmode='locate')
+    pool = FTPSessionPool(host="127.0.0.1", port=port, credentials=("user", None, "password"), size=2)
+    date_ = datetime(2022, 6, 17)
+
+    filepaths, notfound = ingest_native_files([reader], [(date_, term) for term in [1, 2, 3]], pool)
+    # Transfers reuse the sessions of the pool
+    assert len(pool.all_sessions) <= 2
+    pool.close()
+
+    assert notfound == ["hendrix.meteo.fr:/arome/term3.fa"] * 2
+    assert filepaths == [reader.get_path_file_in_native(date_, term) for term in [1, 2]]
+    with open(filepaths[1]) as f:
+        assert f.read() == "native 2"
+
+
+def test_prestaging_pipeline_downloads_chunks_once_prestaged(ftp_server, tmp_path):
+    root, port = ftp_server
+    requests_folder = root / "DemandeMig" / "ChargeEnEspaceRapide"
+    requests_folder.mkdir(parents=True)
+    (root / "arome").mkdir()
+    date_ = datetime(2022, 6, 17)
+    files_by_step = {}
+    for term in [1, 2, 3]:
+        (root / "arome" / f"term{term}.fa").write_text(f"native {term}")
+        files_by_step[(date_, term)] = {str(tmp_path / f"term{term}.fa"): f"/arome/term{term}.fa"}
+    pool = FTPSessionPool(host="127.0.0.1", port=port, credentials=("user", None, "password"), size=2)
+
+    pipeline = PrestagingPipeline(pool, files_by_step, "prestaging", "user@meteo.fr", chunk_size=2, poll_interval=0.05,
+                                  max_file_polls=100)
+    assert [list(chunk) for chunk in pipeline.chunks] == [[(date_, 1), (date_, 2)], [(date_, 3)]]
+    pipeline.start()
+    assert sorted(os.listdir(requests_folder)) == ["prestaging_part0.MIG", "prestaging_part1.MIG"]
+    assert (requests_folder / "prestaging_part1.MIG").read_text() == "#MAIL=user@meteo.fr\n/arome/term3.fa\n"
+
+    # Hendrix consumes the first request, files are downloaded once they are all available
+    assert not pipeline.ready[0].wait(0.2)
+    (root / "arome" / "term2.fa").unlink()
+    (requests_folder / "prestaging_part0.MIG").unlink()
+    assert not pipeline.ready[0].wait(0.2)
+    (root / "arome" / "term2.fa").write_text("native 2")
+    pipeline.wait(date_, 2)
+    assert os.path.isfile(str(tmp_path / "term1.fa")) and os.path.isfile(str(tmp_path / "term2.fa"))
+    assert not os.path.isfile(str(tmp_path / "term3.fa"))
+
+    (requests_folder / "prestaging_part1.MIG").unlink()
+    pipeline.wait(date_, 3)
+    assert not pipeline.errors
+    pipeline.close()
+
+
+def test_prestaging_pipeline_leaves_missing_files_to_vortex(ftp_server, tmp_path):
+    root, port = ftp_server
+    (root / "arome").mkdir()
+    (root / "arome" / "term1.fa").write_text("native 1")
+    pool = FTPSessionPool(host="127.0.0.1", port=port, credentials=("user", None, "password"), size=2)
+    pipeline = PrestagingPipeline(pool, {}, "prestaging", "user@meteo.fr", poll_interval=0.01, max_file_polls=2)
+
+    transfers = {str(tmp_path / f"term{term}.fa"): f"/arome/term{term}.fa" for term in [1, 2]}
+    assert pipeline.wait_for_files("prestaging_part0", transfers) == {str(tmp_path / "term1.fa"): "/arome/term1.fa"}
+    pipeline.close()
+
+
+def test_prestaging_requests_are_submitted_from_sessions_used_to_list_folders(ftp_server, tmp_path):
+    root, port = ftp_server
+    requests_folder = root / "DemandeMig" / "ChargeEnEspaceRapide"
+    requests_folder.mkdir(parents=True)
+    (root / "arome").mkdir()
+    (root / "arome" / "term1.fa").write_text("native 1")
+    pool = FTPSessionPool(host="127.0.0.1", port=port, credentials=("user", None, "password"))
+    with pool.session() as ftp:
+        return_path_if_exists_on_hendrix(ftp, "/arome/term1.fa", DirectoryListingCache(None, ttl=3600))
+
+    # The request is never consumed: its files are left to vortex
+    pipeline = PrestagingPipeline(pool, {(datetime(2022, 6, 17), 1): {str(tmp_path / "term1.fa"): "/arome/term1.fa"}},
+                                  "prestaging", "user@meteo.fr", poll_interval=0.01, max_request_polls=3)
+    pipeline.start()
+    assert sorted(os.listdir(requests_folder)) == ["prestaging_part0.MIG"]
+    assert pipeline.ready[0].wait(5)
+    assert isinstance(pipeline.errors[0], TimeoutError)
+    assert not os.path.isfile(str(tmp_path / "term1.fa"))
+    assert len(pool.all_sessions) == 1
+    pipeline.close()